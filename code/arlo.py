@@ -186,7 +186,32 @@ def declare(s):
 #
 # @TODO: slices, unary operators
 
+class _reserved(object):
+    """
+    Marks an Expr method whose name can't be a column too. On
+    the start of an expression (_.isnull, where.isnull) it raises
+    an error, rather than quietly handing back the bound method.
+    """
+    def __init__(self, method):
+        self.method = method
+        self.__doc__ = method.__doc__
+
+    def __get__(self, instance, owner):
+        if isinstance(instance, StartExpr):
+            name = self.method.__name__
+            raise NameError("%r is reserved for Expr.%s(), so it can't be "
+                            "used as a name here. Use Name(%r) instead."
+                            % (name, name, name))
+        return self.method.__get__(instance, owner)
+
+
 class Expr(object):
+    """
+    Any attribute of an expression is a new DotExpr, except for
+    the methods below: isin, between, isnull and sameAs are
+    reserved, so a column with one of those names has to be
+    written as Name('isnull') rather than where.isnull.
+    """
 
     def __init__(self, left, op, right):
         self.left = left
@@ -208,6 +233,8 @@ class Expr(object):
 
     # (sym, object) -> Expr
     def _build(self, sym, other):
+        if sym in _chainOps:
+            return _chain(sym, self, self._wrap(other, Const))
         return Expr(self, sym, self._wrap(other, Const))
     
     def __repr__(self):
@@ -227,6 +254,27 @@ class Expr(object):
     def __getitem__(self, other):
         return SubExpr(self, self._wrap(other, Name))
 
+    ## predicates (for wherewolf):
+
+    @_reserved
+    def isin(self, values):
+        return InExpr(self, values)
+
+    @_reserved
+    def between(self, lo, hi):
+        return BetweenExpr(self, lo, hi)
+
+    @_reserved
+    def isnull(self):
+        return IsNullExpr(self)
+
+    @_reserved
+    def sameAs(self, other):
+        """
+        Structural equality. (== builds a new expression!)
+        """
+        return structure(self) == structure(other)
+
 
     ## not-so magic method combinators (see lava code below)
 
@@ -357,6 +405,119 @@ class SubExpr(SuffixExpr):
         return '%s[%s]' % (self.left, ','.join(str(s) for s in right))
 
 
+# n-ary chains ######################################
+
+_chainOps = ('&', '|')
+
+# | ChainExpr op (Expr, ...)
+class ChainExpr(Expr):
+    """
+    A chain of terms joined by one associative operator (& or |).
+    ((a & b) & c) & d is built as one node with four terms rather
+    than a tree three levels deep, so long machine-built filters
+    stay flat. .left and .right still work as if it were a tree.
+    """
+
+    def __init__(self, op, terms):
+        self.op = op
+        self._terms = list(terms)
+        self._count = len(self._terms)
+        self.arity = 2
+
+    @property
+    def terms(self):
+        return tuple(self._terms[:self._count])
+
+    @property
+    def left(self):
+        if self._count == 2:
+            return self._terms[0]
+        return ChainExpr(self.op, self._terms[:self._count - 1])
+
+    @property
+    def right(self):
+        return self._terms[self._count - 1]
+
+    def _pattern(self, slots=None):
+        return self.op, self.terms
+
+    def __repr__(self):
+        return '(%s)' % (' %s ' % self.op).join(repr(t) for t in self.terms)
+
+    def __str__(self):
+        return '(%s)' % (' %s ' % self.op).join(str(t) for t in self.terms)
+
+
+def _chain(op, a, b):
+    if a.__class__ is ChainExpr and a.op == op:
+        if len(a._terms) == a._count:
+            # nothing has been chained onto a yet, so we can share
+            # its list (a only ever looks at the first _count terms).
+            # this keeps building a chain one term at a time linear.
+            terms = a._terms
+        else:
+            terms = a._terms[:a._count]
+    else:
+        terms = [a]
+    if b.__class__ is ChainExpr and b.op == op:
+        terms.extend(b.terms)
+    else:
+        terms.append(b)
+    res = ChainExpr.__new__(ChainExpr)
+    res.op, res._terms, res._count, res.arity = op, terms, len(terms), 2
+    return res
+
+
+# predicate constructs ##############################
+
+# | InExpr Expr (Const, ...)
+class InExpr(Expr):
+
+    def __init__(self, left, values):
+        self.left = left
+        self.op = 'in'
+        self.right = tuple(self._wrap(v, Const) for v in values)
+        self.arity = 2
+
+    def __repr__(self):
+        return '%r.isin([%s])' % (self.left, ', '.join(repr(v) for v in self.right))
+
+    def __str__(self):
+        return '(%s in (%s))' % (self.left, ''.join(str(v) + ', ' for v in self.right))
+
+
+# | BetweenExpr Expr (Const, Const)
+class BetweenExpr(Expr):
+
+    def __init__(self, left, lo, hi):
+        self.left = left
+        self.op = 'between'
+        self.right = (self._wrap(lo, Const), self._wrap(hi, Const))
+        self.arity = 2
+
+    def __repr__(self):
+        return '%r.between(%r, %r)' % ((self.left,) + self.right)
+
+    def __str__(self):
+        return '(%s <= %s <= %s)' % (self.right[0], self.left, self.right[1])
+
+
+# | IsNullExpr Expr
+class IsNullExpr(Expr):
+
+    def __init__(self, left):
+        self.left = left
+        self.op = 'isnull'
+        self.right = ()
+        self.arity = 2
+
+    def __repr__(self):
+        return '%r.isnull()' % self.left
+
+    def __str__(self):
+        return '(%s is None)' % self.left
+
+
 # abstract
 class LeafExpr(Expr):
     def __init__(self, x):
@@ -418,6 +579,93 @@ def pattern(ex):
     return ex._pattern()
 
 
+def _hashable(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+def _parts(node):
+    # the pieces of a node, for the walkers below
+    if type(node) == tuple:
+        return node
+    if isinstance(node, LeafExpr):
+        return ()
+    return node._pattern()
+
+
+def _structure(ex, consts):
+    # an explicit stack instead of recursion, so deep trees can't
+    # overflow. todo holds (node, expanded?) and done holds the
+    # keys of the finished nodes, in order.
+    todo, done = [(ex, False)], []
+    while todo:
+        node, expanded = todo.pop()
+        if isinstance(node, Const):
+            if consts is None:
+                # the type matters because 1 == 1.0 == True
+                done.append((Const, type(node.op), _hashable(node.op)))
+            else:
+                consts.append(node.op)
+                done.append((Const,))
+        elif isinstance(node, LeafExpr):
+            done.append((node.__class__, node.op))
+        elif not expanded:
+            todo.append((node, True))
+            for part in reversed(_parts(node)):
+                if isinstance(part, (Expr, tuple)):
+                    todo.append((part, False))
+        else:
+            parts = _parts(node)
+            n = sum(1 for p in parts if isinstance(p, (Expr, tuple)))
+            subs = iter(done[len(done) - n:]) if n else iter(())
+            del done[len(done) - n:]
+            key = tuple(next(subs) if isinstance(p, (Expr, tuple)) else p
+                        for p in parts)
+            done.append(key if type(node) == tuple
+                        else (node.__class__,) + key)
+    return done[0]
+
+
+def structure(ex):
+    """
+    Returns a hashable key for the whole expression, so
+    you can use expressions as (say) dictionary keys:
+
+    structure(_.x == 1) == structure(_.x == 1)
+    """
+    return _structure(ex, None)
+
+
+def shape(ex):
+    """
+    Like structure, but leaves out the constants and
+    returns them separately, in order:
+
+    shape(_.x == 1) -> (key, [1])
+    shape(_.x == 2) -> (the same key, [2])
+    """
+    consts = []
+    return _structure(ex, consts), consts
+
+
+def walk(ex):
+    """
+    Yields ex and every expression inside it, parents first.
+    (Uses a stack, so it's fine on very deep trees.)
+    """
+    todo = [ex]
+    while todo:
+        node = todo.pop()
+        if type(node) != tuple:
+            yield node
+        for part in reversed(_parts(node)):
+            if isinstance(part, (Expr, tuple)):
+                todo.append(part)
+
+
 def transform(f, dispatch, ex):
     """
     uses a family of functions to traverse the
@@ -430,8 +678,36 @@ def transform(f, dispatch, ex):
     for example, pyDispatch is just like sqlDispatch
     except for one rule, but if we hard-coded the 'f'
     we'd have to maintain two copies of each rule
+
+    The walk uses an explicit stack rather than recursion, so
+    deep trees can't overflow: the sub-expressions that have
+    rules in dispatch are transformed first, and when a rule
+    calls f on one of them, it gets the result back directly.
+    Anything else still goes through f.
     """
-    return dispatch[ex.__class__](f, *pattern(ex))
+    todo, done = [(ex, None)], []
+    while todo:
+        node, kids = todo.pop()
+        if kids is None:
+            kids = [k for p in _parts(node)
+                    for k in (p if type(p) == tuple else (p,))
+                    if isinstance(k, Expr) and k.__class__ in dispatch]
+            todo.append((node, kids))
+            for kid in reversed(kids):
+                todo.append((kid, None))
+        else:
+            results = {}
+            if kids:
+                for kid, res in zip(kids, done[len(done) - len(kids):]):
+                    results[id(kid)] = res
+                del done[len(done) - len(kids):]
+            def g(sub, results=results):
+                try:
+                    return results[id(sub)]
+                except KeyError:
+                    return f(sub)
+            done.append(dispatch[node.__class__](g, *pattern(node)))
+    return done[0]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+"""
+boxpack: fast dump/load for strongboxes and graphs of them
+"""
+import json
+import marshal
+from strongbox import attr, link, linkset
+
+# The payload is a plain structure of lists, numbers and strings:
+#
+#   [version, classes, boxes, root]
+#
+# classes: [[name, attrNames, linkNames, linksetNames], ...]
+#          (the slot layout, written once per class)
+# boxes:   one flat list per box: [classNumber, flags, attr values...,
+#          link refs..., linkset ref lists...]
+# root:    a ref, or a list of refs
+#
+# A ref is a box's position in boxes (not its ID), so boxes that
+# are shared or refer to each other in circles come back that way.
+# pack() marshals the payload and toJSON() writes it as json.
+
+VERSION = 1
+
+_DIRTY, _STUB = 1, 2
+
+# values of these types go in as they are. anything else goes
+# in as str(value) and comes back through the attr's type:
+_native = (str, int, float, bool, list, tuple, dict)
+
+
+def _layout(klass):
+    return ([name for name in klass._plainAttrs],
+            [name for name, a in klass.getSlotsOfType(link)],
+            [name for name, a in klass.getSlotsOfType(linkset)])
+
+
+def _encode(value):
+    if value is None or isinstance(value, _native):
+        return value
+    return str(value)
+
+
+def dump(root):
+    """
+    Returns the payload for a box, or a list of boxes, and
+    everything they link to.
+
+    Linksets a clerk hasn't loaded yet are loaded first (the
+    payload has no clerk to do it later), so this can read a
+    lot from the database if the boxes link to a lot. Stubs
+    go in as stubs: just the ID, and the stub flag.
+    """
+    classes, classNums = [], {}
+    boxes, refs = [], {}
+    todo = []
+
+    def ref(box):
+        if box is None:
+            return None
+        try:
+            return refs[id(box)]
+        except KeyError:
+            refs[id(box)] = len(boxes)
+            boxes.append(None) # (filled in below)
+            todo.append(box)
+            return refs[id(box)]
+
+    many = isinstance(root, (list, tuple))
+    res = [ref(box) for box in root] if many else ref(root)
+
+    # a stack rather than recursion, so long chains of links are ok:
+    while todo:
+        box = todo.pop()
+        klass = box.__class__
+        if klass not in classNums:
+            classNums[klass] = len(classes)
+            classes.append([klass.__name__] + list(_layout(klass)))
+        attrs, links, linksets = classes[classNums[klass]][1:]
+        if box.private.injectors:
+            for name in linksets:
+                box.notifyInjectors(name) # (a clerk's lazy loading)
+        pri = box.private # (so we don't set off any other injectors)
+        flags = ((getattr(pri, 'isDirty', False) and _DIRTY)
+                 | (hasattr(pri, 'isStub') and _STUB))
+        record = [classNums[klass], flags]
+        record.extend(_encode(getattr(pri, name)) for name in attrs)
+        record.extend(ref(getattr(pri, name)) for name in links)
+        record.extend([ref(item) for item in getattr(pri, name)]
+                      for name in linksets)
+        boxes[refs[id(box)]] = record
+
+    return [VERSION, classes, boxes, res]
+
+
+def load(payload, classes):
+    """
+    Rebuilds the boxes from a payload made by dump().
+    classes is a list of the box classes it might contain.
+    The boxes don't go through __init__ or the setters.
+    """
+    version, layouts, records, root = payload
+    if version != VERSION:
+        raise ValueError("can't load boxpack version %s" % version)
+    byName = dict((klass.__name__, klass) for klass in classes)
+    plans = [_plan(byName, layout) for layout in layouts]
+
+    boxes = []
+    for record in records:
+        klass, attrs, links, linksets = plans[record[0]]
+        box = klass.__new__(klass)
+        pri = box.private = klass._Private()
+        pri.observers = pri.injectors = None
+        for name, a in klass.getSlotsOfType(attr):
+            if a.__class__ is attr:
+                setattr(pri, name, a.initialValue(box))
+        # (in case the class has links the payload doesn't know about)
+        for name, a in klass.getSlotsOfType(link):
+            setattr(pri, name, None)
+        for name, a in klass.getSlotsOfType(linkset):
+            setattr(pri, name, a.initialValue(box))
+        for (name, a), value in zip(attrs, record[2:]):
+            if a is not None:
+                if not (value is None or isinstance(value, a.type)):
+                    value = a.attemptCast(value)
+                setattr(pri, name, value)
+        pri.isDirty = bool(record[1] & _DIRTY)
+        if record[1] & _STUB:
+            pri.isStub = True
+        boxes.append(box)
+
+    # now that they all exist, connect them:
+    for box, record in zip(boxes, records):
+        klass, attrs, links, linksets = plans[record[0]]
+        pri = box.private
+        pos = 2 + len(attrs)
+        for name in links:
+            ref = record[pos]
+            if name is not None:
+                setattr(pri, name, None if ref is None else boxes[ref])
+            pos += 1
+        for name in linksets:
+            if name is not None:
+                # (plain list.extend: the backlinks came in as links)
+                list.extend(getattr(pri, name),
+                            [boxes[ref] for ref in record[pos]])
+            pos += 1
+
+    if isinstance(root, list):
+        return [boxes[ref] for ref in root]
+    return None if root is None else boxes[root]
+
+
+def _plan(byName, layout):
+    """
+    Matches the layout in the payload to the class as it is now,
+    by name, so fields that were added or dropped since don't
+    throw everything off. (Missing ones get their defaults:
+    None for links, and an empty linkset.)
+    """
+    name, attrNames, linkNames, linksetNames = layout
+    klass = byName[name]
+    attrs, links, linksets = _layout(klass)
+    return (klass,
+            [(n, getattr(klass, n) if n in attrs else None) for n in attrNames],
+            [n if n in links else None for n in linkNames],
+            [n if n in linksets else None for n in linksetNames])
+
+
+def pack(root):
+    """
+    Returns the boxes as compact binary data. (This uses
+    marshal, so only unpack data you made yourself.)
+    """
+    return marshal.dumps(dump(root))
+
+def unpack(data, classes):
+    return load(marshal.loads(data), classes)
+
+
+def toJSON(root):
+    return json.dumps(dump(root), separators=(',', ':'))
+
+def fromJSON(text, classes):
+    return load(json.loads(text), classes)
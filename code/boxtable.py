@@ -0,0 +1,217 @@
+"""
+boxtable: lots of boxes of one class, stored column by column
+"""
+from array import array
+from collections import OrderedDict
+from functools import reduce
+from arlo import Name, structure
+from strongbox import attr
+from wherewolf import toColumnPython, ShapeCache
+import operator
+import re
+
+
+# array typecodes for the attr types that fit in one:
+_typecodes = {int: 'q', float: 'd'}
+
+# the structure of each where clause we've seen -> its code object
+_filters = ShapeCache()
+
+def _compileFilter(ex):
+    return compile("[_i for _i in _rows if %s]" % toColumnPython(ex),
+                   "<where>", "eval")
+
+
+def _pick(column, indices):
+    if isinstance(column, array):
+        return array(column.typecode, [column[i] for i in indices])
+    return [column[i] for i in indices]
+
+
+class BoxTable(object):
+    """
+    Holds the rows for many instances of one StrongBox class,
+    with one column per field instead of one object per row.
+    Columns for int and float attrs are arrays (unless they
+    have to hold a None). Everything else is a list.
+
+    You can filter, sort and total the columns directly.
+    Boxes are only built when you ask for one, by passing
+    its row (a dict) to makeBox. By default that's just
+    klass(**row), but Clerk.matchTable passes its own.
+    """
+
+    def __init__(self, klass, rows=(), makeBox=None):
+        self.klass = klass
+        self.makeBox = makeBox or self._newBox
+        self.columns = OrderedDict()
+        self._attrs = dict((name, a) for name, a in klass.getSlotsOfType(attr)
+                           if a.__class__ is attr)
+        self._length = 0
+        self._boxes = {} # row number -> box, once built
+        self.extend(rows)
+
+    def _newBox(self, row):
+        writable = self.klass.listWritableSlots()
+        return self.klass(**dict((k, v) for k, v in row.items()
+                                 if k in writable))
+
+    def _addColumn(self, name):
+        a = self._attrs.get(name)
+        if a is not None:
+            a.forceLambda()
+        code = _typecodes.get(a.type) if a is not None else None
+        if code and not self._length:
+            column = array(code)
+        else:
+            column = [None] * self._length # (earlier rows didn't have it)
+        self.columns[name] = column
+
+    ## building ##
+
+    def append(self, row):
+        """
+        Adds a row (a dict of column values).
+        """
+        for name in row:
+            if name not in self.columns:
+                self._addColumn(name)
+        for name, column in self.columns.items():
+            value = row.get(name)
+            a = self._attrs.get(name)
+            if not (value is None or a is None or isinstance(value, a.type)):
+                value = a.attemptCast(value)
+            try:
+                column.append(value)
+            except (TypeError, OverflowError):
+                # it doesn't fit in the array (eg, a None),
+                # so fall back to a list:
+                column = self.columns[name] = list(column)
+                column.append(value)
+        self._length += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    ## reading ##
+
+    def __len__(self):
+        return self._length
+
+    def column(self, name):
+        return self.columns[name]
+
+    def row(self, i):
+        return dict((name, column[i]) for name, column in self.columns.items())
+
+    def rows(self):
+        for i in range(self._length):
+            yield self.row(i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(range(*i.indices(self._length)))
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError(i)
+        try:
+            return self._boxes[i]
+        except KeyError:
+            box = self._boxes[i] = self.makeBox(self.row(i))
+            return box
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield self[i]
+
+    ## selecting ##
+
+    def take(self, indices):
+        """
+        Returns a new BoxTable with just the given rows, in that order.
+        """
+        indices = list(indices)
+        res = BoxTable(self.klass, makeBox=self.makeBox)
+        for name, column in self.columns.items():
+            res.columns[name] = _pick(column, indices)
+        res._length = len(indices)
+        res._boxes = dict((j, self._boxes[i]) for j, i in enumerate(indices)
+                          if i in self._boxes)
+        return res
+
+    def filter(self, whereClause=None, **simple):
+        """
+        Returns the rows that match, as a new BoxTable. Takes
+        the same where clauses and keywords as Storage.match,
+        but runs over the columns without building any boxes.
+        """
+        if simple:
+            whereClause = reduce(operator.and_,
+                                 [Name(k) == simple[k] for k in simple])
+        if whereClause is None:
+            return self.take(range(self._length))
+        code = _filters.lookup(structure(whereClause),
+                               _compileFilter, whereClause)
+        env = dict(self.columns)
+        env.update(re=re, _rows=range(self._length))
+        return self.take(eval(code, env))
+
+    def sort(self, orderBy):
+        """
+        Returns the rows sorted by an ORDER BY clause like
+        "name, age desc", as a new BoxTable. As in SQL (and
+        RamStore) None comes first going up, last going down.
+        """
+        indices = list(range(self._length))
+        keys = [(words[0], len(words) > 1 and words[1].lower() == 'desc')
+                for words in [part.split() for part in orderBy.split(',')]]
+        # sort by the last key first: python's sort is stable,
+        # even in reverse, so the earlier keys win.
+        for name, desc in reversed(keys):
+            column = self.columns[name]
+            indices.sort(key=lambda i: (column[i] is not None, column[i]),
+                         reverse=desc)
+        return self.take(indices)
+
+    def groupBy(self, name):
+        """
+        Returns an ordered dict of value -> BoxTable.
+        """
+        groups = OrderedDict()
+        for i, value in enumerate(self.columns[name]):
+            groups.setdefault(value, []).append(i)
+        return OrderedDict((value, self.take(indices))
+                           for value, indices in groups.items())
+
+    ## totals (these skip Nones, like SQL) ##
+
+    def _values(self, name):
+        column = self.columns[name]
+        if isinstance(column, array):
+            return column
+        return [v for v in column if v is not None]
+
+    def count(self, name=None):
+        if name is None:
+            return self._length
+        return len(self._values(name))
+
+    def sum(self, name):
+        return sum(self._values(name))
+
+    def min(self, name):
+        values = self._values(name)
+        return min(values) if len(values) else None
+
+    def max(self, name):
+        values = self._values(name)
+        return max(values) if len(values) else None
+
+    def average(self, name):
+        values = self._values(name)
+        return float(sum(values)) / len(values) if len(values) else None
+
+    def __repr__(self):
+        return "<BoxTable of %s %s>" % (self._length, self.klass.__name__)
@@ -4,10 +4,19 @@ clerk: an object-relational mapper
 """
 from __future__ import with_statement
 import operator
+import threading
+import weakref
+from collections import OrderedDict
+from functools import wraps
 from strongbox import *
 from storage import MockStorage
+from boxtable import BoxTable
+from wherewolf import where
 from handy import Proxy
 
+try: from collections.abc import MutableMapping
+except ImportError: from collections import MutableMapping
+
 class _EMPTY_LINK:
     """
     A Null Object that holds the ID when Link=None
@@ -30,15 +39,230 @@ def _linksAndValues(obj):
             # this won't load data un-necessarily.
 
 
+class _Operation(object):
+    """
+    Labels the statements a storage runs with what the clerk
+    is doing, for instruments like storage.StatementLog. The
+    outermost label wins, so a fetch that goes through match()
+    is still reported as a fetch.
+    """
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+    def __enter__(self):
+        self.outer = self.storage.operation
+        if self.outer is None:
+            self.storage.operation = self.name
+
+    def __exit__(self, *exc):
+        self.storage.operation = self.outer
+
+
+def _operation(name):
+    """
+    Decorator for Clerk methods: see _Operation.
+    """
+    def decorate(method):
+        @wraps(method)
+        def labelled(self, *args, **kwargs):
+            with _Operation(self.storage, name):
+                return method(self, *args, **kwargs)
+        return labelled
+    return decorate
+
+
+def _labelled(storage, name, items):
+    """
+    Yields from items with the _Operation label on while each
+    one is made, but not while the caller has it. (A generator
+    only does its work on next(), long after it's created.)
+    """
+    items = iter(items)
+    while True:
+        with _Operation(storage, name):
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+        yield item
+
+
+def _compileHydrator(klass, columns):
+    """
+    Builds a function that turns a dict of trusted column values
+    into a fresh klass instance, writing straight into .private
+    instead of going through __init__, the setters and observers.
+
+    Only plain attrs with the standard setter are written directly.
+    Anything else in columns (e.g. set_xxx properties) still goes
+    through setattr. Values that aren't already of the attr's type
+    are cast, but never validated.
+    """
+    direct, indirect = [], []
+    for col in columns:
+        prop = getattr(klass, col)
+        if prop.__class__ is attr and prop.fset == prop.wrapSetter:
+            prop.forceLambda()
+            direct.append((col, prop.type, prop.attemptCast))
+        else:
+            indirect.append(col)
+    loaded = [col for col, _, _ in direct]
+    defaults = [(name, a) for name, a in klass.getSlotsOfType(attr)
+                if name not in loaded]
+
+    def hydrate(values):
+        obj = klass.__new__(klass)
+        pri = obj.private = klass._Private()
+        pri.observers = None
+        pri.injectors = None
+        for name, a in defaults:
+            setattr(pri, name, a.initialValue(obj))
+        for name, typ, cast in direct:
+            value = values[name]
+            if not (value is None or isinstance(value, typ)):
+                value = cast(value)
+            setattr(pri, name, value)
+        for name in indirect:
+            setattr(obj, name, values[name])
+        pri.isDirty = False
+        return obj
+
+    return hydrate
+
+
+class LRUTable(OrderedDict):
+    """
+    A per-class cache table that holds at most maxSize objects,
+    evicting the least recently used clean ones first.
+    Dirty objects are never evicted, so the table can grow past
+    maxSize if everything in it has unsaved changes.
+    """
+    def __init__(self, maxSize, onEvict):
+        OrderedDict.__init__(self)
+        self.maxSize = maxSize
+        self.onEvict = onEvict
+
+    def __getitem__(self, key):
+        value = OrderedDict.__getitem__(self, key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxSize:
+            self._shrink()
+
+    def _shrink(self):
+        for key in list(self): # oldest first
+            if len(self) <= self.maxSize:
+                break
+            if not OrderedDict.__getitem__(self, key).private.isDirty:
+                OrderedDict.__delitem__(self, key)
+                self.onEvict()
+
+
+
+class WeakTable(MutableMapping):
+    """
+    A per-class cache table that only holds weak references to
+    clean objects, so they drop out once nothing else refers to
+    them. Dirty objects are pinned with a strong reference until
+    they're stored again. (The table only finds out an object is
+    dirty when it's stored in the table, which the clerk does
+    whenever it hands out a dirty object: see Clerk._track. We
+    don't watch each object, since an observer would take every
+    cached object off strongbox's fast path for setting values.)
+    """
+    def __init__(self, onEvict):
+        self.onEvict = onEvict
+        self._refs = {}
+        self._pinned = {}
+
+    def _expire(self, key, ref):
+        if self._refs.get(key) is ref:
+            del self._refs[key]
+            self.onEvict()
+
+    def __getitem__(self, key):
+        obj = self._refs[key]()
+        if obj is None:
+            raise KeyError(key)
+        return obj
+
+    def __setitem__(self, key, obj):
+        if self.get(key) is not obj:
+            self._refs[key] = weakref.ref(
+                obj, lambda ref, key=key: self._expire(key, ref))
+        if obj.private.isDirty:
+            self._pinned[key] = obj
+        else:
+            self._pinned.pop(key, None)
+
+    def __delitem__(self, key):
+        del self._refs[key]
+        self._pinned.pop(key, None)
+
+    def __iter__(self):
+        for key, ref in list(self._refs.items()):
+            if ref() is not None:
+                yield key
+
+    def __len__(self):
+        return len(self.values())
+
+    def values(self):
+        # (the default would look each key up twice, and the
+        # object might disappear in between)
+        return [obj for obj in [ref() for ref in list(self._refs.values())]
+                if obj is not None]
+
+
+
+class UnboundedPolicy(object):
+    """
+    Keeps every object forever. (This is the default.)
+    """
+    def newTable(self, cache, klass):
+        return {}
+
+
+class LRUPolicy(object):
+    """
+    Keeps at most maxSize clean objects per class.
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+
+    def newTable(self, cache, klass):
+        return LRUTable(self.maxSize, lambda: cache._evicted(klass))
+
+
+class WeakPolicy(object):
+    """
+    Keeps clean objects only as long as something else refers to them.
+    """
+    def newTable(self, cache, klass):
+        return WeakTable(lambda: cache._evicted(klass))
+
+
+
 class Cache(object):
     """
     Cache[klass][ID] = instance
+
+    The policy decides how long objects stay in the cache (see
+    UnboundedPolicy, LRUPolicy and WeakPolicy). The hits, misses
+    and evictions counters are there to help you size it.
     """
-    def __init__(self):
+    def __init__(self, policy=None):
+        self.policy = policy or UnboundedPolicy()
         self.data = {}
         self.index = {}
         self.allCached = {}
         self.caching = [] # klasses currently being cached
+        self.hits = self.misses = self.evictions = 0
 
     def __getitem__(self, key):
         klass, ID = key
@@ -47,24 +271,46 @@ class Cache(object):
 
     def __setitem__(self, key, value):
         klass, ID = key
-        self.data.setdefault(klass, {})[ID] = value
+        if klass not in self.data:
+            self.data[klass] = self.policy.newTable(self, klass)
+        self.data[klass][ID] = value
 
 
-    def markCached(self, klass):
-        self.allCached[klass] = True 
+    def _evicted(self, klass):
+        # once something is gone, the table (and its index)
+        # no longer holds the complete set of rows:
+        self.evictions += 1
+        self.allCached.pop(klass, None)
+        self.index.pop(klass, None)
+
+    def markCached(self, klass, count=None):
+        """
+        Notes that klass's whole table is in the cache,
+        unless some of the count objects were already evicted.
+        """
+        if count is None or len(self.data.get(klass, ())) >= count:
+            self.allCached[klass] = True 
 
     def clear(self):
         self.data.clear()
 
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    size=sum(len(t) for t in self.data.values()))
+
 
     def get(self, klass, key):
         try:
-            return self.data[klass][key]
+            obj = self.data[klass][key]
         except KeyError:
+            self.misses += 1
             return None
+        self.hits += 1
+        return obj
 
     def delete(self, klass, key):
-        if self.get(klass, key):
+        if key in self.data.get(klass, ()):
             del self.data[klass][key]
 
     def store(self, obj):
@@ -81,12 +327,29 @@ class Clerk(object):
     Clerk is an object-relational mapper, responsible
     for storing strongbox-style objects in storage
     systems defined with the 'storage' module.
+
+    A clerk (with its cache, stubs, and injectors) is not
+    thread-safe. In a threaded server, use ThreadLocalClerk
+    to give each thread its own clerk.
     """
 
-    def __init__(self, storage, schema):
+    def __init__(self, storage, schema, trusted_rows=False, cache=None):
+        """
+        If trusted_rows is True, new objects are built from the
+        database rows by a compiled loader (see _compileHydrator)
+        rather than the constructor, so onSet, observers and the
+        .okay validators are skipped. Only use it when the data
+        in storage was written by (something like) a clerk.
+
+        Pass in a cache (eg, Cache(LRUPolicy(1000))) to bound
+        how many objects the clerk keeps in memory.
+        """
         self.storage = storage
         self.schema = schema
-        self.cache = Cache()
+        self.cache = cache if cache is not None else Cache()
+        self.trusted_rows = trusted_rows
+        self._hydrators = {}
+        self._session = None
 
 
     def _addLinksAndStubs(self, obj, othercols):
@@ -120,7 +383,67 @@ class Clerk(object):
             pass # no point adding injectors if we're loading the whole table
         self._addLinkSetInjectors(stub)
         self.cache.store(stub)
-        return stub
+        return self._track(stub)
+
+
+    def _rowToPartial(self, row, klass):
+        """
+        Like _rowToInstance, but for rows with only some of the
+        columns. New objects come back as stubs with just those
+        slots filled in, and the rest load on demand.
+        """
+        cached = self.cache.get(klass, row.get("ID"))
+        if cached:
+            return self._track(cached)
+        attrs, othercols = self._writable_and_other_columns(klass, row)
+        obj = klass(ID=attrs.pop("ID"))
+        for name, value in attrs.items():
+            # cast the raw column values, as the hydrator does:
+            prop = getattr(klass, name)
+            if isinstance(prop, attr):
+                prop.forceLambda()
+                if not (value is None or isinstance(value, prop.type)):
+                    value = prop.attemptCast(value)
+            setattr(obj.private, name, value)
+        self._addLinksAndStubs(obj, othercols)
+        loaded = set(attrs)
+        for name, lnk in klass.getSlotsOfType(link):
+            if self.schema.columnForLink(lnk) in othercols:
+                loaded.add(name)
+        obj.private.isDirty = False
+        obj.private.isStub = True
+        obj.addInjector(LinkInjector(self, klass, obj.ID, loaded).inject)
+        obj.addObserver(LinkInjector(self, klass, obj.ID, loaded).inject)
+        self._addLinkSetInjectors(obj)
+        self.cache.store(obj)
+        return self._track(obj)
+
+
+    def _columnsFor(self, klass, names):
+        """
+        Maps slot names to column names for match(columns=...).
+        The ID always comes first.
+        """
+        columns = ["ID"]
+        for name in names:
+            slot = getattr(klass, name, None)
+            if isinstance(slot, link):
+                name = self.schema.columnForLink(slot)
+            if name not in columns:
+                columns.append(name)
+        return columns
+
+
+    def _track(self, obj):
+        """
+        Lets the open session (if any) watch obj for changes,
+        and lets the cache know if obj has changes to keep.
+        """
+        if self._session is not None:
+            self._session._watch(obj)
+        if obj.private.isDirty:
+            self.cache.store(obj) # (so a WeakTable pins it)
+        return obj
 
 
     def _recursive_store(self, obj, seen):
@@ -180,6 +503,15 @@ class Clerk(object):
 
             obj = cached
 
+            # If the object is a stub, we have to clear the flag
+            # *before* calling update(), because update() notifies
+            # the stub's LinkInjector, and that injector would
+            # otherwise go right back to the database for the
+            # row we're already holding.
+            wasStub = hasattr(obj.private, 'isStub')
+            if wasStub:
+                del obj.private.isStub
+
             # the rule: changes in ram trump changes is the DB
             # otherwise, you can make changes, think you're saving
             # them, and find out your changes were discarded. That
@@ -201,11 +533,9 @@ class Clerk(object):
                 # but now it is dirty, so mark it clean:
                 obj.private.isDirty = False
 
-            if hasattr(obj.private, 'isStub'):
-                # The object is marked as a stub, but it's
+            if wasStub:
+                # The object was marked as a stub, but it's
                 # not a stub anymore, because we just filled it in!
-                # So we have to fix that.
-                del obj.private.isStub
 
                 # Also, since we have the foreign keys now
                 # (in the othercols dict),  we need to take
@@ -220,13 +550,17 @@ class Clerk(object):
         else:
         
             # in here we're dealing with a brand new object
-            obj = klass(**attrs)
+            if self.trusted_rows:
+                obj = self._hydrator(klass, tuple(attrs))(attrs)
+            else:
+                obj = klass(**attrs)
+            # (clean before it goes in the cache, so it isn't pinned)
+            obj.private.isDirty = False
             self.cache.store(obj)
             self._addLinksAndStubs(obj, othercols)
             self._addLinkSetInjectors(obj)
-            obj.private.isDirty = False
                 
-        return obj
+        return self._track(obj)
 
 
 
@@ -234,9 +568,7 @@ class Clerk(object):
 
         if obj.private.isDirty:
 
-            vals = obj.attributeValues()
-            for lnkObj, ref in _linksAndValues(obj):
-                vals[self.schema.columnForLink(lnkObj)]=ref.ID
+            vals = self._rowFor(obj)
             klass = obj.__class__
             data_from_db = self.storage.store(
                 self.schema.tableForClass(klass), **vals)
@@ -258,6 +590,58 @@ class Clerk(object):
             pass
                     
 
+    def _rowFor(self, obj):
+        """
+        Returns the dict of column values to store for obj.
+        """
+        vals = obj.attributeValues()
+        for lnkObj, ref in _linksAndValues(obj):
+            vals[self.schema.columnForLink(lnkObj)]=ref.ID
+        return vals
+
+
+    def _dependencyLevels(self, objs):
+        """
+        Walks the object graph from objs and returns a list of
+        lists of objects, ordered so that every new object comes
+        at a later level than the new objects it links to.
+        (Objects that already have an ID don't hold anything up.)
+
+        Like _recursive_store, this breaks cycles by ignoring the
+        link that closes the loop (storeMany goes back and fills
+        those in afterwards). Unlike _recursive_store, it uses an
+        explicit stack, so long chains are fine.
+        """
+        level = {} # obj -> level, or None while we're still visiting
+        finished = []
+        stack = [(obj, False) for obj in reversed(objs)]
+        def links(obj):
+            # (private, so we don't trigger any lazy loading)
+            return [ref for ref in [getattr(obj.private, name)
+                                    for name, _ in obj.getSlotsOfType(link)]
+                    if ref is not None]
+        while stack:
+            obj, done = stack.pop()
+            if done:
+                level[obj] = max([level[ref] + 1 for ref in links(obj)
+                                  if level.get(ref) is not None
+                                  and not ref.ID] or [0])
+                finished.append(obj)
+                # linkset items depend on obj, so visit them afterwards:
+                for name, _ in obj.getSlotsOfType(linkset):
+                    for item in reversed(getattr(obj.private, name)):
+                        stack.append((item, False))
+            elif obj not in level:
+                level[obj] = None
+                stack.append((obj, True))
+                for ref in links(obj):
+                    stack.append((ref, False))
+        levels = {}
+        for obj in finished:
+            levels.setdefault(level[obj], []).append(obj)
+        return [levels[k] for k in sorted(levels)]
+
+
     def _writable_and_other_columns(self, klass, rec):
         """
         this separates the rec dictionary into two
@@ -270,8 +654,7 @@ class Clerk(object):
         For example: calculated fields.
         """
         attrs, others = {}, {}
-        #@TODO: listWritableSlots probably ought to be a classmethod
-        writables = klass().listWritableSlots()
+        writables = klass.listWritableSlots()
         for item in rec.keys():
             if item in writables:
                 attrs[item]=rec[item]
@@ -284,6 +667,101 @@ class Clerk(object):
         return self._writable_and_other_columns(klass, rec)[0]
 
 
+    def _hydrator(self, klass, columns):
+        """
+        Returns the (cached) trusted-row loader for klass and columns.
+        """
+        key = (klass, columns)
+        if key not in self._hydrators:
+            self._hydrators[key] = _compileHydrator(klass, columns)
+        return self._hydrators[key]
+
+
+    ## batched loading ###############################################
+
+    prefetchBatchSize = 100
+
+    def _matchBatches(self, klass, column, values):
+        """
+        Yields the rows of klass's table where column is one of the
+        values, using one query per prefetchBatchSize values.
+        """
+        values = list(values)
+        table = self.schema.tableForClass(klass)
+        size = self.prefetchBatchSize
+        for i in range(0, len(values), size):
+            clause = getattr(where, column).isin(values[i:i+size])
+            for row in self.storage.match(table, clause):
+                yield row
+
+
+    def _prefetch(self, klass, objs, names):
+        """
+        Loads the named links and linksets for all the objs at once,
+        rather than letting each injector fire its own query.
+        """
+        for name in names:
+            slot = getattr(klass, name, None)
+            if isinstance(slot, linkset):
+                self._prefetchLinkSet(objs, name, slot)
+            elif isinstance(slot, link):
+                self._prefetchLink(objs, name, slot)
+            else:
+                raise ClerkError("can't prefetch %s.%s: not a link or linkset"
+                                 % (klass.__name__, name))
+
+
+    def _prefetchLink(self, objs, name, lnk):
+        # private, so we don't fire the stubs' injectors ourselves:
+        refs = [getattr(obj.private, name) for obj in objs]
+        stubIDs = []
+        for ref in refs:
+            if (ref is not None and hasattr(ref.private, 'isStub')
+                and ref.ID not in stubIDs):
+                stubIDs.append(ref.ID)
+        # _rowToInstance finds each stub in the cache and fills it in:
+        for row in self._matchBatches(lnk.type, "ID", stubIDs):
+            self._rowToInstance(row, lnk.type)
+
+
+    def _prefetchLinkSet(self, objs, name, ls):
+        ls.forceLambda()
+        if ls.type in self.cache.allCached:
+            return # the LinkSetInjectors will use the cache anyway.
+
+        parents = [obj for obj in objs
+                   if self._detachLinkSetInjectors(obj, name)]
+        if not parents:
+            return
+
+        column = self.schema.columnForLinkSet(ls)
+        kids = {}
+        for row in self._matchBatches(ls.type, column,
+                                      [p.ID for p in parents]):
+            kids.setdefault(row[column], []).append(
+                self._rowToInstance(row, ls.type))
+
+        for parent in parents:
+            theLinkSet = getattr(parent.private, name)
+            for kid in kids.get(parent.ID, []):
+                theLinkSet << kid
+
+
+    def _detachLinkSetInjectors(self, obj, name):
+        """
+        Removes the LinkSetInjectors for obj.name, and returns
+        True if there were any (i.e., if the linkset wasn't loaded yet).
+        """
+        found = False
+        for callbacks in (obj.private.injectors, obj.private.observers):
+            for callback in list(callbacks or ()):
+                lsi = getattr(callback, '__self__', None)
+                if isinstance(lsi, LinkSetInjector) and lsi.name == name:
+                    callbacks.remove(callback)
+                    found = True
+        return found
+
+
 
     ## public interface ##############################################
         
@@ -314,46 +792,82 @@ class Clerk(object):
             return self.match(klass)
        
 
+    @_operation("delete")
     def delete(self, klass, ID): #@TODO: ick!!
         """
         Delete the instance of klass with the given ID
         """
+        if self._session is not None:
+            return self._session.delete(klass, ID)
+        self._delete(klass, ID)
+        return None
+
+    def _delete(self, klass, ID):
         self.storage.delete(self.schema.tableForClass(klass), ID)
         self.cache.delete(klass, ID)
-        return None
 
 
+    @_operation("fetch")
     def fetch(self, klass, __ID__=None, **kw):
         """
         Like matchOne, but lets you pass in a primary key.
         """
         if __ID__:
             assert not kw, "ID and where are mutually exclusive for fetch"
-            return (self.cache.get(klass, __ID__)
-                    or self.matchOne(klass, ID=__ID__))
+            cached = self.cache.get(klass, __ID__)
+            if cached:
+                return self._track(cached)
+            return self.matchOne(klass, ID=__ID__)
         else:
             return self.matchOne(klass, **kw)
 
 
+    @_operation("match")
     def match(self, klass, *args, **kwargs):
         """
         Returns a list of matched objects.
+
+        Pass prefetch=[names] to load those links and linksets for
+        the whole result set up front, with one query per relation
+        (per prefetchBatchSize objects) instead of one per object.
+
+        Pass limit and/or offset to get one page of the results.
+        Pass columns=[names] to load only those attributes and
+        links: new objects come back as stubs that load the rest
+        if you touch it.
         """
-        if (klass in self.cache.allCached) and (not args):
+        prefetch = kwargs.pop("prefetch", None)
+        paging = dict((k, kwargs.pop(k)) for k in ("limit", "offset")
+                      if kwargs.get(k) is not None)
+        columns = kwargs.pop("columns", None)
+        if (klass in self.cache.allCached) and not (
+                args or paging or kwargs.get("orderBy")):
             # @TODO: real where clauses for live objects
+            # (and the storage does the sorting and paging, so the
+            # order of the pages matches an uncached match)
+            kwargs.pop("orderBy", None)
             matches = []
             for item in self.cache.data[klass].values():
                 keepThisOne = True
                 for k,v in kwargs.items():
                     if getattr(item, k) != v:
                         keepThisOne = False
-                if keepThisOne: matches.append(item)
+                if keepThisOne: matches.append(self._track(item))
+        elif columns is not None:
+            matches = [self._rowToPartial(row, klass)
+                       for row in self.storage.match(
+                          self.schema.tableForClass(klass), *args,
+                          columns=self._columnsFor(klass, columns),
+                          **dict(kwargs, **paging))]
         else:
             matches = [self._rowToInstance(row, klass)
                        for row in self.storage.match(
-                          self.schema.tableForClass(klass), *args, **kwargs)]
-        if not (args or kwargs):
-            self.cache.markCached(klass)
+                          self.schema.tableForClass(klass), *args,
+                          **dict(kwargs, **paging))]
+        if not (args or kwargs or paging or columns is not None):
+            self.cache.markCached(klass, len(matches))
+        if prefetch:
+            self._prefetch(klass, matches, prefetch)
         return matches
 
     def matchOne(self, klass, *arg, **kw):
@@ -371,14 +885,121 @@ class Clerk(object):
         return res[0]
 
 
+    @_operation("matchTable")
+    def matchTable(self, klass, *args, **kwargs):
+        """
+        Like match, but returns a BoxTable that holds the rows
+        column by column. No objects are built up front: each
+        box is made (and cached) the first time you look at it.
+
+        As with match, boxes you've changed but not stored yet
+        count with their values in ram, not the ones in the db.
+        """
+        rows = self.storage.match(self.schema.tableForClass(klass),
+                                  *args, **kwargs)
+        cached = self.cache.data.get(klass)
+        if cached:
+            rows = [self._overlay(row, cached.get(row.get("ID")))
+                    for row in rows]
+        return BoxTable(klass, rows,
+                        lambda row: self._rowToInstance(row, klass))
+
+    def _overlay(self, row, obj):
+        """
+        Returns row with obj's unsaved changes (if any) laid over it.
+        """
+        if obj is None or not obj.private.isDirty:
+            return row
+        row = dict(row)
+        row.update((k, v) for k, v in self._rowFor(obj).items() if k in row)
+        return row
+
+
+    def iterMatch(self, klass, *args, **kwargs):
+        """
+        Like match, but yields the objects one at a time as the
+        storage streams the rows in (see Storage.iterMatch).
+
+        The objects still go in the cache, so give the clerk a
+        bounded cache (LRUPolicy or WeakPolicy) if you want memory
+        to stay flat over a big result set.
+        """
+        with _Operation(self.storage, "iterMatch"):
+            rows = self.storage.iterMatch(
+                self.schema.tableForClass(klass), *args, **kwargs)
+        return _labelled(self.storage, "iterMatch",
+                         (self._rowToInstance(row, klass) for row in rows))
+
+
+    @_operation("store")
     def store(self, obj):
         """
         Store the object
         along with any linked objects marked with .isDirty = True.
+
+        Inside a session, this just adds obj to the session, and
+        the actual write happens when the session ends.
         """
+        if self._session is not None:
+            return self._session.store(obj)
         return self._recursive_store(obj, seen={})
 
 
+    @_operation("store")
+    def storeMany(self, objs):
+        """
+        Like store, but for a whole list of objects at once.
+
+        The dirty objects in the graph are written with one batched
+        insert or update per table at each level of link dependency
+        (see _dependencyLevels), and new objects get their IDs from
+        the storage without having their rows read back. So unlike
+        store(), any other values the database fills in for you
+        (timestamps, etc.) are not loaded into the objects.
+        """
+        # a link that closes a cycle among new objects gets written
+        # before its target has an ID, so we come back for those:
+        unfinished = []
+        for group in self._dependencyLevels(objs):
+            byClass = {}
+            for obj in group:
+                if obj.private.isDirty:
+                    byClass.setdefault(obj.__class__, []).append(obj)
+            for klass, dirty in byClass.items():
+                table = self.schema.tableForClass(klass)
+                new = [obj for obj in dirty if not obj.ID]
+                old = [obj for obj in dirty if obj.ID]
+                if new:
+                    unfinished.extend(
+                        obj for obj in new
+                        if [ref for _, ref in _linksAndValues(obj)
+                            if ref is not _EMPTY_LINK and not ref.ID])
+                    IDs = self.storage.insertMany(
+                        table, [self._rowFor(obj) for obj in new])
+                    for obj, ID in zip(new, IDs):
+                        obj.update(ID=ID)
+                if old:
+                    self.storage.updateMany(
+                        table, [self._rowFor(obj) for obj in old])
+                for obj in dirty:
+                    obj.private.isDirty = False
+                    self.cache.store(obj)
+        byClass = {}
+        for obj in unfinished:
+            byClass.setdefault(obj.__class__, []).append(obj)
+        for klass, loose in byClass.items():
+            self.storage.updateMany(self.schema.tableForClass(klass),
+                                    [self._rowFor(obj) for obj in loose])
+        return objs
+
+
+    def session(self):
+        """
+        Returns a new unit of work. See ClerkSession.
+        """
+        return ClerkSession(self)
+
+
 
 
 
@@ -399,11 +1020,20 @@ class CallbackClerk(Clerk):
         
     def store(self, thing):
         thing = super(CallbackClerk, self).store(thing)
+        if self._session is not None:
+            return thing # callbacks happen in storeMany, at the flush
         klass = thing.__class__
         for callback in self._callbacks.get(klass, []):
             callback(thing)
         return thing
 
+    def storeMany(self, things):
+        things = super(CallbackClerk, self).storeMany(things)
+        for thing in things:
+            for callback in self._callbacks.get(thing.__class__, []):
+                callback(thing)
+        return things
+
 
 
 class ClerkError(Exception):
@@ -416,7 +1046,7 @@ class ClerkError(Exception):
 
 class LinkInjector:
 
-    def __init__(self, clerk, fclass, fID):
+    def __init__(self, clerk, fclass, fID, loaded=()):
         """
         Registers a callback so that when getattr(box, atr)
         is called, the object of box.atr's type with given ID
@@ -424,10 +1054,15 @@ class LinkInjector:
 
         In other words, this provides lazy loading for
         strongboxen.
+
+        loaded names slots that are already filled in
+        (see Clerk.match's columns option), so reading
+        them doesn't trigger the load.
         """
         self.clerk = clerk
         self.fID = fID
         self.fclass = fclass
+        self.loaded = loaded
 
     def inject(self, stub, name, value=Unspecified):
         """
@@ -446,6 +1081,8 @@ class LinkInjector:
             # stubs have .ID, so no need to load
             # same thing with linksets!
             pass
+        elif name in self.loaded and value is Unspecified:
+            pass # already have it
         else:
             stub.removeInjector(self.inject)
             stub.removeObserver(self.inject)
@@ -459,9 +1096,10 @@ class LinkInjector:
 
                 # can't use the clerk directly here because 
                 # fetch would just return the cached box! :)
-                raw = self.clerk.storage.fetch(
-                    self.clerk.schema.tableForClass(self.fclass),
-                    self.fID)
+                with _Operation(self.clerk.storage, "inject"):
+                    raw = self.clerk.storage.fetch(
+                        self.clerk.schema.tableForClass(self.fclass),
+                        self.fID)
 
                 # inject the data:
                 for slot in stub.listWritableSlots():
@@ -534,7 +1172,9 @@ class LinkSetInjector:
                             theLinkSet << obj
             else:
                 # no cache at all; hit the database.
-                for obj in self.clerk.match(childType, **{self.fkey:box.ID}):
+                with _Operation(self.clerk.storage, "inject"):
+                    kids = self.clerk.match(childType, **{self.fkey:box.ID})
+                for obj in kids:
                     theLinkSet << obj
 
 
@@ -645,3 +1285,169 @@ class BoxClerkProxy(Proxy):
         with self:
             thunk(self.obj)
 
+
+
+class ClerkSession(Proxy):
+    """
+    A unit of work. It's a proxy for the clerk, so you can write:
+
+    with clerk.session() as s:
+        obj = s.fetch(Thing, 1)
+        obj.x = 5
+        s.store(Thing(x=6))
+
+    Objects the clerk loads while the session is open are watched
+    through their observer hooks, and store() (on the session or
+    the clerk) just makes a note of the object. When the block
+    ends, everything dirty is written with clerk.storeMany() in a
+    single storage transaction. Deletes wait for the end of the
+    block, too, and happen after the stores, in the same
+    transaction. If the block raises an exception, nothing is
+    written (or deleted) at all.
+
+    Note that this means new objects don't get their IDs until
+    the end of the block.
+    """
+
+    def __init__(self, clerk):
+        super(ClerkSession, self).__init__(clerk)
+        self.__dict__['clerk'] = clerk
+        self.__dict__['outer'] = None
+        self.__dict__['watched'] = {}
+        self.__dict__['pending'] = {} # obj -> True (flushed in order)
+        self.__dict__['deleted'] = [] # (klass, ID) pairs, in order
+
+    def __enter__(self):
+        self.__dict__['outer'] = self.clerk._session
+        self.clerk._session = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.clerk._session = self.outer
+        for obj in self.watched:
+            obj.removeObserver(self._touched)
+        if type is None:
+            self.flush()
+        else:
+            # nothing has been written, so just let the exception go
+            self.pending.clear()
+            del self.deleted[:]
+        return False
+
+    def _watch(self, obj):
+        if obj not in self.watched:
+            self.watched[obj] = True
+            obj.addObserver(self._touched)
+            if obj.private.isDirty:
+                self.pending[obj] = True
+
+    def _touched(self, obj, slot, value):
+        # observer callback: obj is about to become dirty
+        self.pending[obj] = True
+
+    def store(self, obj):
+        self._watch(obj)
+        self.pending[obj] = True
+        return obj
+
+    def delete(self, klass, ID):
+        self.deleted.append((klass, ID))
+
+    def flush(self):
+        """
+        Writes all the pending objects and deletes in one transaction.
+        If that fails, the objects and the cache are put back the way
+        they were (new objects lose their IDs, and the changes are
+        still pending), so you can fix the problem and flush again.
+        """
+        storage = self.clerk.storage
+        saved = self._save()
+        storage.begin()
+        try:
+            self.clerk.storeMany(list(self.pending))
+            for klass, ID in self.deleted:
+                self.clerk._delete(klass, ID)
+        except:
+            storage.rollback()
+            self._restore(saved)
+            raise
+        storage.commit()
+        self.pending.clear()
+        del self.deleted[:]
+
+    def _save(self):
+        """
+        Notes what storeMany and delete might change in memory: each
+        object's ID and dirty flag, and what the cache held for it.
+        """
+        cache = self.clerk.cache.data
+        objs = [obj for level in self.clerk._dependencyLevels(list(self.pending))
+                for obj in level]
+        return ([(obj, obj.ID, obj.private.isDirty) for obj in objs],
+                [(klass, ID, cache.get(klass, {}).get(ID))
+                 for klass, ID in self.deleted])
+
+    def _restore(self, saved):
+        cache = self.clerk.cache
+        objs, deleted = saved
+        for obj, ID, isDirty in objs:
+            if obj.ID != ID:
+                # it was new, and shouldn't be cached under its new ID:
+                if cache.data.get(obj.__class__, {}).get(obj.ID) is obj:
+                    cache.delete(obj.__class__, obj.ID)
+                obj.private.ID = ID
+            obj.private.isDirty = isDirty
+        for klass, ID, obj in deleted:
+            if obj is not None:
+                cache.store(obj)
+
+
+
+class ThreadLocalClerk(object):
+    """
+    Stands in for a clerk, but gives each thread its own, built
+    by makeClerk() the first time the thread uses it.
+
+    This is the concurrency model for clerks: nothing that a clerk
+    touches (its cache, the stubs and injectors it makes, or its
+    storage's connection and cursor) is shared between threads.
+    Each thread has its own identity map, so objects loaded in one
+    thread must not be handed to another. To share the database,
+    have makeClerk() build each storage on a shared ConnectionPool:
+
+        pool = ConnectionPool(lambda: MySQLdb.connect(...))
+        clerk = ThreadLocalClerk(
+            lambda: Clerk(MySQLStorage(pool=pool), schema))
+
+    Call reset() at the end of each request, so the next request
+    on that thread starts with an empty cache, and the connection
+    goes back to the pool.
+    """
+
+    def __init__(self, makeClerk):
+        self.__dict__['_makeClerk'] = makeClerk
+        self.__dict__['_local'] = threading.local()
+
+    def current(self):
+        """
+        Returns this thread's clerk.
+        """
+        try:
+            return self._local.clerk
+        except AttributeError:
+            clerk = self._local.clerk = self._makeClerk()
+            return clerk
+
+    def reset(self):
+        """
+        Throws away this thread's clerk.
+        """
+        clerk = self._local.__dict__.pop('clerk', None)
+        if clerk is not None and hasattr(clerk.storage, 'release'):
+            clerk.storage.release()
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.current(), name, value)
@@ -1,19 +1,319 @@
 from storage import Storage
-from wherewolf import toPython
-from arlo import Expr
-from warnings import warn
-from copy import copy
+from wherewolf import toParamPython, toParamSQL, where, ShapeCache
+from wherewolf import simplify, isFalse, like
+from arlo import Expr, DotExpr, Name, Const, StartExpr
+from arlo import InExpr, BetweenExpr, IsNullExpr, ChainExpr
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+import heapq
+from decimal import Decimal
+import time
+import re
+
+
+# the code for each shape of expression -> its code object.
+# the constants are passed in separately, so where.x == 1 and
+# where.x == 2 share one entry.
+_predicates = ShapeCache()
+_maxPredicates = 1000
+
+# rows are passed to eval() as the locals, so the row itself never
+# gets a __builtins__ key and we don't need to copy it.
+_predicateGlobals = {"re": re, "_like": like}
+
+
+# arlo.Expr -> (code, globals)
+def compilePredicate(ex):
+    source, params = toParamPython(ex)
+    env = dict(_predicateGlobals)
+    env.update(params)
+    return _predicates.lookup(source, _compile, source), env
+
+def _compile(source):
+    return compile(source, "<where>", "eval")
+
+# Expr -> (column, op, value) or None
+def _comparison(ex):
+    """
+    If ex compares a column to constants (where.x < 5,
+    where.x.isin([1, 2]), ...), returns the pieces.
+    Otherwise returns None.
+    """
+    cls = ex.__class__
+    if not (cls in _comparable
+            and isinstance(ex.left, DotExpr)
+            and isinstance(ex.left.left, StartExpr)
+            and isinstance(ex.left.right, Name)):
+        return None
+    column = ex.left.right.op
+    if cls is Expr:
+        if ex.op in _rangeOps and isinstance(ex.right, Const):
+            return column, ex.op, ex.right.op
+        return None
+    if cls is IsNullExpr:
+        return column, '==', None
+    if not all(isinstance(c, Const) for c in ex.right):
+        return None
+    values = [c.op for c in ex.right]
+    if cls is BetweenExpr:
+        return column, 'between', tuple(values)
+    return column, 'in', values
+
+_comparable = (Expr, InExpr, BetweenExpr, IsNullExpr)
+
+_rangeOps = ('==', '<', '<=', '>', '>=')
+
+
+class _Descending(object):
+    """
+    Wraps a sort key so it sorts backwards.
+    """
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class _Above(object):
+    """
+    Compares greater than anything else, to find the end of a
+    run of keys in a sorted list.
+    """
+    __slots__ = []
+
+    def __gt__(self, other):
+        return True
+
+    def __lt__(self, other):
+        return False
+
+_ABOVE = _Above()
+
+
+_numberTypes = (int, float, Decimal)
+
+def sortKey(value):
+    """
+    Wraps a value so any mix of values can be sorted without a
+    TypeError (as python 3 would raise for None < 1, or 1 < "a").
+    None sorts first, like NULL in SQL, then numbers, and then
+    everything else, grouped by type.
+    """
+    if value is None:
+        return (0, "", None)
+    elif isinstance(value, _numberTypes):
+        return (1, "", value)
+    else:
+        return (2, type(value).__name__, value)
+
+
+# the key function for each orderBy string we've seen
+_orderKeys = {}
+
+# str -> (row -> key)
+def orderKey(orderBy):
+    """
+    Turns an ORDER BY clause like "name, age desc" into a key
+    function for sorting rows. As in SQL, None (NULL) comes
+    first in ascending columns and last in descending ones.
+    (See sortKey for how other mixed values are ordered.)
+    """
+    try:
+        return _orderKeys[orderBy]
+    except KeyError:
+        pass
+    cols = []
+    for part in orderBy.split(','):
+        words = part.split()
+        cols.append((words[0],
+                     len(words) > 1 and words[1].lower() == 'desc'))
+    def key(row):
+        res = []
+        for col, desc in cols:
+            value = sortKey(row[col])
+            res.append(_Descending(value) if desc else value)
+        return res
+    if len(_orderKeys) >= _maxPredicates:
+        _orderKeys.clear()
+    _orderKeys[orderBy] = key
+    return key
+
+
+class HashIndex(object):
+    """
+    Finds the rows where a column == some value.
+    """
+    def __init__(self, column):
+        self.column = column
+        self.rows = {}  # value -> {ID: row}
+        self.keyOf = {} # ID -> the value the row was filed under
+
+    def add(self, row):
+        value = row.get(self.column)
+        self.rows.setdefault(value, {})[row["ID"]] = row
+        self.keyOf[row["ID"]] = value
+
+    def remove(self, row):
+        # we use keyOf because row may have been changed in place
+        value = self.keyOf.pop(row["ID"])
+        bucket = self.rows[value]
+        del bucket[row["ID"]]
+        if not bucket:
+            del self.rows[value]
+
+    def lookup(self, op, value):
+        if op != '==':
+            return None
+        return list(self.rows.get(value, {}).values())
+
+
+class SortedIndex(object):
+    """
+    Keeps the rows sorted by a column, for range queries. The
+    values are kept as sortKeys, so mixed types don't break it,
+    and a range only covers values of the same kind as its bound.
+    Rows where the column is None are left out, since a comparison
+    with NULL never matches anyway.
+    """
+    def __init__(self, column):
+        self.column = column
+        self.keys = []
+        self.rows = []  # parallel to self.keys
+        self.keyOf = {}
+
+    def add(self, row):
+        value = row.get(self.column)
+        self.keyOf[row["ID"]] = value
+        if value is None:
+            return
+        i = bisect_right(self.keys, sortKey(value))
+        self.keys.insert(i, sortKey(value))
+        self.rows.insert(i, row)
+
+    def remove(self, row):
+        ID = row["ID"]
+        value = self.keyOf.pop(ID)
+        if value is None:
+            return
+        i = bisect_left(self.keys, sortKey(value))
+        while self.rows[i]["ID"] != ID:
+            i += 1
+        del self.keys[i]
+        del self.rows[i]
+
+    def lookup(self, op, value):
+        if value is None:
+            return None
+        keys = self.keys
+        key = sortKey(value[0] if op == 'between' else value)
+        # the run of values of the same kind as this one:
+        first = bisect_left(keys, key[:2])
+        last = bisect_right(keys, key[:2] + (_ABOVE,))
+        try:
+            if op == 'between':
+                top = sortKey(value[1])
+                if top[:2] != key[:2]:
+                    return None # mixed bounds: let the full scan sort it out
+                lo, hi = bisect_left(keys, key), bisect_right(keys, top)
+            elif op == '==':
+                lo, hi = bisect_left(keys, key), bisect_right(keys, key)
+            elif op == '<':
+                lo, hi = first, bisect_left(keys, key)
+            elif op == '<=':
+                lo, hi = first, bisect_right(keys, key)
+            elif op == '>':
+                lo, hi = bisect_right(keys, key), last
+            else: # '>='
+                lo, hi = bisect_left(keys, key), last
+        except TypeError:
+            return None # values that don't compare: full scan
+        return self.rows[lo:hi]
+
 
 class RamStore(Storage):
+    """
+    Keeps each table as an ordered dict of ID -> row, so
+    lookups by ID are cheap. Use addIndex() to index other
+    columns; match() uses the indexes when it can.
+    """
 
     def __init__(self):
         self._tables = {}
         self._counter = {}
+        self._indexes = {} # table -> {column: index}
+        self._undo = None   # see begin()
 
     def _ensuretable(self, name):
         if not name in self._tables:
-            self._tables[name]=[]
+            self._tables[name]={}
             self._counter[name]=0
+            self._indexes[name]={}
+
+    def addIndex(self, table, column, ordered=False):
+        """
+        Indexes table by column. A plain index helps with ==.
+        An ordered index helps with ==, <, <=, >, and >= too,
+        but costs more to update.
+        """
+        self._ensuretable(table)
+        index = (SortedIndex if ordered else HashIndex)(column)
+        for row in self._tables[table].values():
+            index.add(row)
+        self._indexes[table][column] = index
+
+    def _reindex(self, tables):
+        for table in tables:
+            for column, index in list(self._indexes[table].items()):
+                self.addIndex(table, column, isinstance(index, SortedIndex))
+
+    def begin(self):
+        Storage.begin(self)
+        # (table, ID) -> the row as it was before the transaction
+        # touched it, or None if the transaction inserted it:
+        self._undo = {}
+        self._savedCounter = dict(self._counter)
+
+    def _touch(self, table, ID, row):
+        """
+        Remembers how a row looked before we change it, so
+        rollback() can put it back.
+        """
+        if self._undo is not None and (table, ID) not in self._undo:
+            self._undo[(table, ID)] = None if row is None else dict(row)
+
+    def commit(self):
+        Storage.commit(self)
+        self._undo = None
+
+    def rollback(self):
+        Storage.rollback(self)
+        if self._undo:
+            touched, undeleted = set(), set()
+            for (table, ID), row in self._undo.items():
+                rows = self._tables[table]
+                if row is None:
+                    rows.pop(ID, None)
+                elif ID in rows:
+                    # put it back in place, in case someone's holding it
+                    rows[ID].clear()
+                    rows[ID].update(row)
+                else:
+                    rows[ID] = row
+                    undeleted.add(table)
+                touched.add(table)
+            for table in undeleted:
+                # those went back in at the end, so restore the order:
+                self._tables[table] = dict(sorted(self._tables[table].items()))
+            for table in self._counter:
+                self._counter[table] = self._savedCounter.get(table, 0)
+            self._reindex(touched)
+        self._undo = None
 
     def _nextid(self, table):
         self._counter[table] += 1
@@ -21,79 +321,180 @@ class RamStore(Storage):
 
     # (arlo.Expr, Dict) -> Bool
     def _matchRow(self, ex, row):
-        # we make a copy here, or else eval()
-        # will add __builtins__ to the row!
-        context = copy(row)
-        return bool(eval(toPython(ex), context))
+        code, env = compilePredicate(ex)
+        return bool(eval(code, env, row))
+
+    def fetch(self, table, ID):
+        self._ensuretable(table)
+        if self.instrument is not None:
+            self._recordStatement("SELECT * FROM", table, where.ID == ID,
+                                  time.time(), 1)
+        try:
+            return self._tables[table][ID]
+        except (KeyError, TypeError):
+            raise LookupError("match(%r, ID=%r) returned 0 rows."
+                              % (table, ID))
 
     def store(self, table, **row):
         self._ensuretable(table)
         return Storage.store(self, table, **row)
 
+    def insertMany(self, table, rows):
+        self._ensuretable(table)
+        return Storage.insertMany(self, table, rows)
+
+    def updateMany(self, table, rows):
+        self._ensuretable(table)
+        Storage.updateMany(self, table, rows)
+
+    def _recordStatement(self, kind, table, where, started, rows):
+        # describe what we did as sql, so it looks like the
+        # statements the other storages report
+        sql, params = ("%s %s" % (kind, table)), []
+        if where is not None:
+            whereSQL, params = toParamSQL(where)
+            sql += " WHERE " + whereSQL
+        self._record(sql, params, started, rows)
+
     def _update(self, table, **row):
-        rec = self.fetch(table, row["ID"])
+        if self.instrument is not None:
+            started = time.time()
+            rec = self._update_main(table, row)
+            self._recordStatement("UPDATE", table, where.ID == row["ID"],
+                                  started, 1)
+            return rec
+        return self._update_main(table, row)
+
+    def _update_main(self, table, row):
+        # (not through fetch(), which would log a SELECT)
+        rec = self._tables[table].get(row["ID"])
+        if rec is None:
+            raise LookupError("match(%r, ID=%r) returned 0 rows."
+                              % (table, row["ID"]))
+        self._touch(table, rec["ID"], rec)
+        indexes = [index for column, index in self._indexes[table].items()
+                   if column in row]
+        for index in indexes:
+            index.remove(rec)
         rec.update(row)
+        for index in indexes:
+            index.add(rec)
         return rec
 
     def _insert(self, table, **row):
+        if self.instrument is not None:
+            started = time.time()
+            rec = self._insert_main(table, row)
+            self._recordStatement("INSERT INTO", table, None, started, 1)
+            return rec
+        return self._insert_main(table, row)
+
+    def _insert_main(self, table, row):
         rec = {}
         rec.update(row)
         rec["ID"] = self._nextid(table)
-        self._tables[table].append(rec)
+        self._touch(table, rec["ID"], None)
+        self._tables[table][rec["ID"]] = rec
+        for index in self._indexes[table].values():
+            index.add(rec)
         return rec
 
-    def _match(self, table, where=None, orderBy=None):
+    def _remove(self, table, row):
+        self._touch(table, row["ID"], row)
+        del self._tables[table][row["ID"]]
+        for index in self._indexes[table].values():
+            index.remove(row)
+
+    def _candidates(self, table, where):
+        """
+        Uses the ID and the indexes to find a (hopefully short) list
+        of rows that might match where. Returns None if it can't.
+        """
+        if where.__class__ in (Expr, ChainExpr) and where.op == '&':
+            terms = (where.terms if where.__class__ is ChainExpr
+                     else (where.left, where.right))
+            found = [rows for rows in (self._candidates(table, t) for t in terms)
+                     if rows is not None]
+            return min(found, key=len) if found else None
+        comparison = _comparison(where)
+        if comparison is None:
+            return None
+        column, op, value = comparison
+        try:
+            if op == 'in':
+                # the union of the lookups for each value:
+                found = {}
+                for each in set(value):
+                    rows = self._lookup(table, column, '==', each)
+                    if rows is None:
+                        return None
+                    found.update((row["ID"], row) for row in rows)
+                return list(found.values())
+            return self._lookup(table, column, op, value)
+        except TypeError:
+            return None # unhashable value
+
+    def _lookup(self, table, column, op, value):
+        if column == "ID" and op == '==':
+            row = self._tables[table].get(value)
+            return [row] if row is not None else []
+        index = self._indexes[table].get(column)
+        if index is None:
+            return None
+        return index.lookup(op, value)
+
+    def _match(self, table, where=None, orderBy=None,
+               limit=None, offset=None, columns=None):
+        if isFalse(where):
+            return [] # can't match anything, so don't bother looking
+        if self.instrument is not None:
+            started = time.time()
+            rows = self._match_main(table, where, orderBy, limit, offset, columns)
+            self._recordStatement("SELECT * FROM", table, where, started, len(rows))
+            return rows
+        return self._match_main(table, where, orderBy, limit, offset, columns)
+
+    def _match_main(self, table, where, orderBy, limit, offset, columns):
         self._ensuretable(table)
         if where is None:
-            rows = self._tables[table]
+            rows = list(self._tables[table].values())
+        else:
+            code, env = compilePredicate(where)
+            rows = self._candidates(table, where)
+            if rows is None:
+                rows = self._tables[table].values()
+            else:
+                rows = sorted(rows, key=itemgetter("ID")) # table order
+            rows = [row for row in rows
+                    if eval(code, env, row)]
+        start = offset or 0
+        if limit is not None:
+            if orderBy is not None:
+                # only sort as much as we need for this page:
+                rows = heapq.nsmallest(start + limit, rows, key=orderKey(orderBy))
+            rows = rows[start:start + limit]
         else:
-            rows = [row for row
-                    in self._tables[table]
-                    if self._matchRow(where, row)]
-        if orderBy is not None:
-            # parse orderBy
-            # break columns into a list of tuples,
-            # each containing a field name and sort direction
-            setcol = lambda x: ((x.split()[0], 'desc') if x.lower().endswith(' desc')
-                                else (x.strip(), 'asc'))
-            cols = [setcol(c) for c in orderBy.split(',')]
-
-            # invert() takes n and returns its opposite (invert(15) == -15)
-            # rcmp() is a reverse of the cmp() function
-            invert = lambda x: x-2*x
-            rcmp = lambda x, y: invert(cmp(x, y))
-
-            def listsort(x, y):
-                """
-                for each column, do a cmp() or rcmp()
-                if the columns are equal, move to the next to sort
-                if all columns are equal then return 0
-                """
-                for c in cols:
-                    i = c[1]=='asc' and cmp(x[c[0]], y[c[0]]) or rcmp(x[c[0]], y[c[0]])
-                    if i: return i
-                return i
-            rows.sort(listsort)
+            if orderBy is not None:
+                rows.sort(key=orderKey(orderBy))
+            if start:
+                rows = rows[start:]
+        if columns is not None:
+            rows = [dict((col, row[col]) for col in columns) for row in rows]
         return rows
 
 
     def delete(self, table, whereClause):
         self._ensuretable(table)
-        rows = self._tables[table]
-        if isinstance(whereClause, Expr):
-            # repeat until no rows are deleted
-            l = 1
-            while l > 0:
-                l = len(self.__deleteMatch(whereClause, rows))
-        else:
-            for i in range(len(rows)):
-                if rows[i]["ID"]==long(whereClause):
-                    rows.remove(rows[i])
-                    break
-
-    def __deleteMatch(self, where, rows):
-        # the loop stops once a row is deleted
-        return [rows.remove(row) for row
-                in rows
-                if self._matchRow(where, row)]
-
+        if not isinstance(whereClause, Expr):
+            # might be a string, int, or long
+            whereClause = (where.ID == int(whereClause))
+        whereClause = simplify(whereClause)
+        if isFalse(whereClause):
+            return
+        started = time.time()
+        rows = self._match_main(table, whereClause, None, None, None, None)
+        for row in rows:
+            self._remove(table, row)
+        if self.instrument is not None:
+            self._recordStatement("DELETE FROM", table, whereClause,
+                                  started, len(rows))
@@ -4,12 +4,15 @@ storage: a module for storing tabular data
 # * dependencies
 import operator
 import unittest
+import threading
+import time
 from functools import reduce
-from warnings import warn
 from pytypes import Date
+from decimal import Decimal
+import datetime
 import sqlite3 as sqlite
-from arlo import Expr, Name
-from wherewolf import where, toSQL
+from arlo import Expr, Name, Const
+from wherewolf import where, toParamSQL, simplify, simplifyForSQL
 
 # optional depedencies
 try: import sqlite3 as sqlite
@@ -18,12 +21,106 @@ except ImportError: sqlite = None
 try: from sets import Set as set
 except ImportError: pass # okay in modern python
 
-try: import MySQLdb
+try: import MySQLdb, MySQLdb.cursors
 except ImportError: MySQLdb = None
 
 
+# values the database drivers can bind as they are:
+_bindable = (bool, int, float, str, bytes, bytearray,
+             datetime.date, datetime.time, datetime.timedelta, Decimal)
+
+
+class StatementEvent(object):
+    """
+    One statement a storage ran, for instruments.
+    operation is what the clerk was doing at the time
+    (match, fetch, store, inject...), or None.
+    """
+    __slots__ = ['statement', 'params', 'seconds', 'rows', 'operation']
+
+    def __init__(self, statement, params, seconds, rows, operation):
+        self.statement = statement
+        self.params = params
+        self.seconds = seconds
+        self.rows = rows
+        self.operation = operation
+
+    def __repr__(self):
+        return "<%s %r %r (%s rows, %.4fs)>" % (
+            self.operation, self.statement, self.params,
+            self.rows, self.seconds)
+
+
+class StatementLog(object):
+    """
+    An instrument that keeps every statement, so you can see
+    what a page or request actually did:
+
+        log = storage.instrument = StatementLog()
+        ... handle the request ...
+        for stat in log.summary(): print(stat)
+        log.reset()
+
+    Since values are bound as parameters, the statement text is
+    the shape of the query. A shape that runs nPlusOne or more
+    times with different values is flagged as 'suspect': that's
+    usually a loop loading one object at a time (the N+1 problem),
+    which should be a prefetch or a join instead.
+    """
+
+    def __init__(self, nPlusOne=5):
+        self.nPlusOne = nPlusOne
+        self.events = []
+
+    def record(self, event):
+        self.events.append(event)
+
+    def reset(self):
+        self.events = []
+
+    def summary(self):
+        """
+        Returns a dict for each statement shape, slowest first.
+        """
+        stats = {}
+        for e in self.events:
+            stat = stats.get(e.statement)
+            if stat is None:
+                stat = stats[e.statement] = dict(
+                    statement=e.statement, count=0, seconds=0.0, rows=0,
+                    operations=set(), params=set())
+            stat["count"] += 1
+            stat["seconds"] += e.seconds
+            stat["rows"] += max(e.rows or 0, 0)
+            stat["operations"].add(e.operation)
+            stat["params"].add(repr(e.params))
+        for stat in stats.values():
+            stat["suspect"] = (stat["count"] >= self.nPlusOne
+                               and len(stat.pop("params")) > 1)
+        return sorted(stats.values(), key=lambda s: -s["seconds"])
+
+    def suspects(self):
+        """
+        Returns the summaries that look like N+1 patterns.
+        """
+        return [stat for stat in self.summary() if stat["suspect"]]
+
+
 class Storage(object):
 
+    ## instrumentation:
+    # set .instrument to anything with a record(event) method
+    # (like a StatementLog) to see each statement as it runs.
+    # The clerk sets .operation while it works.
+    instrument = None
+    operation = None
+
+    def _record(self, statement, params, started, rows=None):
+        event = StatementEvent(statement, params, time.time() - started,
+                               rows, self.operation)
+        self.instrument.record(event)
+        return event
+
     def store(self, table, **row):
         if row.get("ID"):
             return self._update(table, **row)
@@ -37,17 +134,81 @@ class Storage(object):
                   % (table, ID, len(res)))
         return res[0]
 
+    def insertMany(self, table, rows):
+        """
+        Inserts a list of row dicts and returns their IDs, in order.
+        Unlike store(), backends that can batch the inserts don't
+        read the new rows back.
+        """
+        return [self._insert(table, **row)["ID"] for row in rows]
+
+    def updateMany(self, table, rows):
+        """
+        Updates a list of row dicts, each of which must have an ID.
+        """
+        for row in rows:
+            self._update(table, **row)
+
+    ## transactions:
+    # storage writes normally take effect right away. Between
+    # begin() and commit() they may be held back, and rollback()
+    # throws them away. Backends that can't do that just ignore it.
+    inTransaction = False
+
+    def begin(self):
+        self.inTransaction = True
+
+    def commit(self):
+        self.inTransaction = False
+
+    def rollback(self):
+        self.inTransaction = False
+
     ## abstract:
     def delete(self, table, ID):
         raise NotImplementedError
         
-    def match(self, table, whereClause=None, orderBy=None, **simple):
+    def match(self, table, whereClause=None, orderBy=None,
+              limit=None, offset=None, columns=None, **simple):
+        """
+        Returns a list of row dicts. limit and offset give you
+        one page of the results, and columns lets you ask for
+        just some of the columns.
+        """
+        whereClause = self._whereFor(whereClause, simple)
+        if limit is None and offset is None and columns is None:
+            # (so older _match()es without these options still work)
+            return self._match(table, whereClause, orderBy)
+        return self._match(table, whereClause, orderBy,
+                           limit=limit, offset=offset, columns=columns)
+
+    batchSize = 1000 # rows per fetch for iterMatch()
+
+    def iterMatch(self, table, whereClause=None, orderBy=None,
+                  batchSize=None, **simple):
+        """
+        Like match, but returns an iterator over the rows.
+        Backends that can stream the rows from the database
+        fetch them batchSize at a time, so memory use stays
+        flat no matter how many rows match.
+        """
+        return iter(self.match(table, whereClause, orderBy, **simple))
+
+    # how to simplify a where clause for this backend. (see
+    # wherewolf: the rules differ for python and sql)
+    _simplify = staticmethod(simplify)
+
+    def _whereFor(self, whereClause, simple):
         assert not (whereClause and simple), \
                "where/simple queries are mutually exclusive"
         if simple:
             whereClause = reduce(operator.and_,
                                  [Name(k)==simple[k] for k in simple])
-        return self._match(table, whereClause, orderBy)
+        if isinstance(whereClause, Expr):
+            whereClause = self._simplify(whereClause)
+            if isinstance(whereClause, Const) and whereClause.op:
+                whereClause = None # matches everything
+        return whereClause
 
     # @TODO: this came unchanged from Clerk. Can Clerk subclass Storage??
     def matchOne(self, klass, *arg, **kw):
@@ -78,49 +239,315 @@ class Storage(object):
 from ramstore import RamStore as RamStorage
 MockStorage = RamStorage
 
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Shares up to maxSize database connections between storages.
+
+    connect is a function that opens a new connection. Idle
+    connections older than idleTimeout seconds get closed instead
+    of reused, and the others are checked with isHealthy() before
+    they're handed out. If all maxSize connections are in use,
+    checkout() waits up to timeout seconds (forever if None) for
+    one to come back.
+
+    A storage made with pool= checks a connection out the first
+    time it needs one and keeps it until commit(), rollback() or
+    release(), so give each thread or request its own storage.
+    """
+
+    def __init__(self, connect, maxSize=10, idleTimeout=300, timeout=None):
+        self.connect = connect
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.timeout = timeout
+        self.size = 0  # connections open, idle or not
+        self.idle = [] # (dbc, time it was checked in)
+        self._lock = threading.Condition()
+
+    def checkout(self):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while True:
+            dbc = self._reserve(deadline)
+            if dbc is None:
+                break
+            # the health check is a round trip to the server, so
+            # it runs without the lock. (dbc still counts in size,
+            # so nobody else can open one in its place meanwhile.)
+            if self.isHealthy(dbc):
+                return dbc
+            self.discard(dbc)
+        try:
+            return self.connect()
+        except:
+            self.discard(None)
+            raise
+
+    def _reserve(self, deadline):
+        """
+        Waits for an idle connection and returns it, or
+        returns None once there's room to open a new one.
+        """
+        with self._lock:
+            while True:
+                while self.idle:
+                    dbc, since = self.idle.pop()
+                    if time.time() - since < self.idleTimeout:
+                        return dbc
+                    self._close(dbc)
+                if self.size < self.maxSize:
+                    self.size += 1
+                    return None
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0:
+                    raise PoolTimeout("all %s connections are in use"
+                                      % self.maxSize)
+                self._lock.wait(wait)
+
+    def checkin(self, dbc):
+        with self._lock:
+            self.idle.append((dbc, time.time()))
+            self._lock.notify()
+
+    def discard(self, dbc):
+        """
+        Closes a connection that's gone bad instead of reusing it.
+        """
+        with self._lock:
+            if dbc is not None:
+                self._close(dbc)
+            else:
+                self.size -= 1
+            self._lock.notify()
+
+    def _close(self, dbc):
+        # (caller holds the lock)
+        self.size -= 1
+        try:
+            dbc.close()
+        except Exception:
+            pass
+
+    def isHealthy(self, dbc):
+        try:
+            cur = dbc.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchall()
+            cur.close()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        with self._lock:
+            while self.idle:
+                self._close(self.idle.pop()[0])
+
     
 class MySQLStorage(Storage):
 
-    def __init__(self, dbc):
-        self.dbc = dbc
-        self.cur = dbc.cursor()
+    placeholder = "%s" # parameter marker for the driver's paramstyle
+    _simplify = staticmethod(simplifyForSQL)
+    noLimit = 18446744073709551615 # LIMIT for "offset but no limit"
+
+    # MySQLdb returns SET and ENUM columns as sets, and reports
+    # ENUMs as plain strings in cursor.description. With some
+    # other driver, we don't know, so check every column (None).
+    setTypes = (frozenset([MySQLdb.FIELD_TYPE.SET, MySQLdb.FIELD_TYPE.ENUM,
+                           MySQLdb.FIELD_TYPE.STRING])
+                if MySQLdb else None)
+    maxStatements = 500 # how many statements to keep in _statements
+
+    def __init__(self, dbc=None, pool=None):
+        """
+        Pass either a connection or a ConnectionPool.
+        """
+        assert (dbc is None) != (pool is None), "need a dbc or a pool"
+        self.pool = pool
+        self._dbc = dbc
+        self._cur = dbc.cursor() if dbc is not None else None
+        self._statements = {}
+
+    @property
+    def dbc(self):
+        if self._dbc is None:
+            self._dbc = self.pool.checkout()
+            self._cur = None
+        return self._dbc
+
+    @property
+    def cur(self):
+        if self._cur is None:
+            self._cur = self.dbc.cursor()
+        return self._cur
+
+    def release(self):
+        """
+        Gives the connection back to the pool, if there is one.
+        """
+        if self.pool is not None and self._dbc is not None:
+            # (detach it first: rollback() releases too)
+            dbc, self._dbc, self._cur = self._dbc, None, None
+            if self.inTransaction:
+                # an unfinished transaction mustn't go to the next user:
+                self.inTransaction = False
+                dbc.rollback()
+            self.pool.checkin(dbc)
 
 
-    def _dictify(self, cur):
+    def _dictify(self, cur, rows=None):
         """
-        converts cursor.fetchall() results into a list of dicts
-        also removes Set() for enums.
+        converts cursor.fetchall() results (or the given rows)
+        into a list of dicts also removes Set() for enums.
         """
+        if rows is None:
+            rows = cur.fetchall()
+        names = tuple(d[0] for d in cur.description)
+        sets = self._setColumns(cur.description)
+        if not sets:
+            return [dict(zip(names, row)) for row in rows]
         res = []
-        for row in cur.fetchall():
-            d = {}
-            for i in range(len(cur.description)):
-                d[cur.description[i][0]] = (
-                    row[i].pop() if isinstance(row[i], set) else row[i] )
+        for row in rows:
+            d = dict(zip(names, row))
+            for name in sets:
+                if isinstance(d[name], set):
+                    d[name] = d[name].pop() if d[name] else None
             res.append(d)
         return res
 
+    def _setColumns(self, description):
+        """
+        Returns the names of the columns that might come back
+        as sets, so _dictify only has to check those.
+        """
+        if self.setTypes is None:
+            return [d[0] for d in description]
+        return [d[0] for d in description if d[1] in self.setTypes]
 
-    def _toSQLString(self, val):
+
+    def _toParam(self, val):
         """
-        Turns a value into a quoted string suitable for MySQL
+        Turns a value into something the driver can bind as a parameter.
+        The types drivers bind natively go in as they are, and anything
+        else (our own pytypes, FixedPoint, your own attr types...) goes
+        in as a string.
         """
-        if isinstance(val, Date) and str(val)=='0-0-0':                
-            return "NULL"
-        elif val is None:
-            return "NULL"
+        if isinstance(val, Date) and str(val)=='0-0-0':
+            return None
+        elif val is None or isinstance(val, _bindable):
+            return val
         else:
-            return "'" + "''".join(str(val).split("'")) + "'"
-            
+            return str(val)
 
-    def _insert_main(self, table, **row):
-        # generate column/value lists for INSERT
-        cols = ', '.join(row.keys())
-        vals = ', '.join([self._toSQLString(v) for v in row.values()])
 
-        sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, cols, vals)
-        self._execute(sql)
+    def _statement(self, key, build, *args):
+        """
+        Returns the sql for key, calling build(*args) to make
+        it the first time. The statements only have placeholders
+        for the values, so the same text gets reused (and the db
+        can reuse its plan) no matter what the values are.
+        """
+        try:
+            return self._statements[key]
+        except KeyError:
+            if len(self._statements) >= self.maxStatements:
+                self._statements.clear()
+            sql = self._statements[key] = build(*args)
+            return sql
+
+    def _insertSQL(self, table, cols):
+        return self._statement(("insert", table, cols), lambda: (
+            "INSERT INTO %s (%s) VALUES (%s)"
+            % (table, ', '.join(cols), ', '.join([self.placeholder]*len(cols)))))
+
+    def _updateSQL(self, table, cols):
+        return self._statement(("update", table, cols), lambda: (
+            "UPDATE %s SET %s WHERE ID=%s"
+            % (table, ', '.join("%s=%s" % (c, self.placeholder) for c in cols),
+               self.placeholder)))
+
+    def _selectSQL(self, table, whereSQL, orderBy, columns=None, paged=False):
+        def build():
+            sql = ["SELECT %s FROM %s" % (', '.join(columns or ['*']), table)]
+            if whereSQL is not None:
+                sql.append(" WHERE %s" % whereSQL)
+            if orderBy is not None:
+                sql.append(" ORDER BY %s" % orderBy)
+            if paged:
+                sql.append(" LIMIT %s OFFSET %s"
+                           % (self.placeholder, self.placeholder))
+            return ''.join(sql)
+        return self._statement(
+            ("select", table, whereSQL, orderBy, columns, paged), build)
+
+    def _whereParams(self, where):
+        """
+        Returns the parameterized sql for an arlo
+        expression, along with the values to bind.
+        """
+        whereSQL, params = toParamSQL(where, self.placeholder)
+        return whereSQL, [self._toParam(p) for p in params]
+
+
+    def _groupByColumns(self, rows):
+        """
+        Groups rows with the same columns together, so each group
+        can be sent with one executemany(). Returns a list of
+        (cols, [(index, row), ...]) pairs.
+        """
+        groups = {}
+        for i, row in enumerate(rows):
+            groups.setdefault(tuple(sorted(row)), []).append((i, row))
+        return groups.items()
+
+
+    def insertMany(self, table, rows):
+        # a blank ID means "generate one", same as store()
+        rows = [dict((k, v) for k, v in row.items() if k != "ID" or v)
+                for row in rows]
+        ids = [None] * len(rows)
+        for cols, batch in self._groupByColumns(rows):
+            sql = self._insertSQL(table, cols)
+            params = [[self._toParam(row[c]) for c in cols] for _, row in batch]
+            newIDs = self._insertMany(table, sql, params)
+            if "ID" in cols:
+                newIDs = [row["ID"] for _, row in batch]
+            for (i, _), ID in zip(batch, newIDs):
+                ids[i] = ID
+        return ids
+
+    def _insertMany(self, table, sql, params):
+        """
+        Runs the INSERTs and returns the generated IDs.
+        """
+        # MySQL only reports the first ID of a multi-row insert, and
+        # the rest needn't be consecutive (interleaved inserts, or
+        # innodb_autoinc_lock_mode=2), so we go one row at a time
+        # and ask after each:
+        ids = []
+        for row in params:
+            self._execute(sql, row)
+            ids.append(self._getInsertID())
+        return ids
+
+
+    def updateMany(self, table, rows):
+        for cols, batch in self._groupByColumns(rows):
+            cols = tuple(c for c in cols if c != "ID")
+            sql = self._updateSQL(table, cols)
+            self._execute(sql, [[self._toParam(row[c]) for c in cols]
+                                + [row["ID"]] for _, row in batch],
+                          many=True)
+
 
+    def _insert_main(self, table, **row):
+        cols = tuple(sorted(row))
+        self._execute(self._insertSQL(table, cols),
+                      [self._toParam(row[c]) for c in cols])
         return self._getInsertID()
 
     def _insert(self, table, **row):
@@ -142,85 +569,243 @@ class MySQLStorage(Storage):
 
 
     def _update(self, table, **row):
+        cols = tuple(sorted(row))
+        self._execute(self._updateSQL(table, cols),
+                      [self._toParam(row[c]) for c in cols] + [row["ID"]])
+        return self.fetch(table, row["ID"])
+        
 
-        sql = "UPDATE " + table + " SET"
-        for col,val in row.iteritems():
-            sql += " " + col + "=" + self._toSQLString(val) + ","
-        sql = sql[:-1]
+    def _match(self, table, where=None, orderBy=None,
+               limit=None, offset=None, columns=None):
+        whereSQL, params = None, []
+        if where is not None:
+            whereSQL, params = self._whereParams(where)
+        paged = not (limit is None and offset is None)
+        if paged:
+            params.append(self.noLimit if limit is None else limit)
+            params.append(offset or 0)
+        if columns is not None:
+            columns = tuple(columns)
+        self._execute(self._selectSQL(table, whereSQL, orderBy, columns, paged),
+                      params or None)
+        res = self._dictify(self.cur)
+        if self.instrument is not None:
+            self._event.rows = len(res)
+        return res
 
-        # whoops! thanks to Andy Todd for this line:
-        sql += " WHERE ID = %d" % row["ID"]
 
-        self._execute(sql)
-        return self.fetch(table, row["ID"])
-        
+    # MySQL won't run any other query on a connection until a
+    # streamed result has been read all the way through:
+    streamsShareConnection = False
+
+    def iterMatch(self, table, whereClause=None, orderBy=None,
+                  batchSize=None, **simple):
+        """
+        Like match, but returns an iterator over the rows. Other
+        queries still work while you're iterating: the rows stream
+        in over a connection of their own from the pool, or (with no
+        pool, or in a transaction) come batchSize at a time, as one
+        query per page.
+        """
+        where = self._whereFor(whereClause, simple)
+        batchSize = batchSize or self.batchSize
+        if self.streamsShareConnection:
+            return self._stream(self.dbc, table, where, orderBy, batchSize)
+        elif self.pool is not None and not self.inTransaction:
+            dbc = self.pool.checkout()
+            try:
+                return self._stream(dbc, table, where, orderBy, batchSize,
+                                    lambda: self.pool.checkin(dbc))
+            except:
+                self.pool.discard(dbc)
+                raise
+        else:
+            return self._iterPages(table, where, orderBy, batchSize)
 
-    def _match(self, table, where=None, orderBy=None):
-        sql = ["SELECT * FROM %s" % table]
+    def _stream(self, dbc, table, where, orderBy, batchSize, done=None):
+        whereSQL, params = None, None
         if where is not None:
-            sql.append(" WHERE %s" % toSQL(where))
-        if orderBy is not None:
-            sql.append(" ORDER BY %s" % orderBy)
-            # sql.append(" LIMIT 1000")
-        sql = ''.join(sql)
-        self._execute(sql)
-        return self._dictify(self.cur)
+            whereSQL, params = self._whereParams(where)
+        cur = self._streamCursor(dbc)
+        self._execute(self._selectSQL(table, whereSQL, orderBy), params, cur=cur)
+        return self._iterRows(cur, batchSize, done)
+
+    def _iterRows(self, cur, batchSize, done=None):
+        try:
+            while True:
+                rows = cur.fetchmany(batchSize)
+                if not rows:
+                    break
+                for row in self._dictify(cur, rows):
+                    yield row
+        finally:
+            cur.close()
+            if done is not None:
+                done()
+
+    def _iterPages(self, table, where, orderBy, batchSize):
+        # each page is a whole query, so nothing is left open on the
+        # connection while we yield. In ID order, each page starts
+        # after the last ID we saw, so the database seeks straight to
+        # it instead of counting off an OFFSET, and rows stored or
+        # deleted along the way can't shift the pages. (With an
+        # orderBy, the ID keeps ties in order.)
+        offset, lastID = 0, None
+        while True:
+            if orderBy:
+                rows = self._match(table, where, orderBy + ", ID",
+                                   limit=batchSize, offset=offset)
+            else:
+                page = where
+                if lastID is not None:
+                    page = Name("ID") > lastID
+                    if where is not None:
+                        page = page & where
+                rows = self._match(table, page, "ID", limit=batchSize)
+            for row in rows:
+                yield row
+            if len(rows) < batchSize:
+                break
+            offset += batchSize
+            lastID = rows[-1]["ID"]
+
+    def _streamCursor(self, dbc):
+        """
+        Returns a cursor that leaves the results on the server.
+        """
+        if MySQLdb:
+            return dbc.cursor(MySQLdb.cursors.SSCursor)
+        return dbc.cursor()
         
 
     def delete(self, table, where):
         if isinstance(where, Expr):
-            self._execute("DELETE FROM %s WHERE %s" % (table, toSQL(where)))
+            whereSQL, params = self._whereParams(where)
+            self._execute("DELETE FROM %s WHERE %s" % (table, whereSQL), params)
         else:
             # might be a string, int, or long
-            self._execute("DELETE FROM %s WHERE ID=%s" % (table, where))
+            self._execute("DELETE FROM %s WHERE ID=%s" % (table, self.placeholder),
+                          [where])
+
+
+    def begin(self):
+        self._execute("START TRANSACTION")
+        self.inTransaction = True
+
+    def commit(self):
+        self.inTransaction = False
+        self.dbc.commit()
+        self.release()
 
+    def rollback(self):
+        self.inTransaction = False
+        self.dbc.rollback()
+        self.release()
 
-    def _execute(self, sql):
+    # errors that might just mean the connection died:
+    connectionErrors = (MySQLdb.OperationalError,) if MySQLdb else ()
+
+    def _reconnect(self, cur):
+        """
+        Called when a statement fails with one of the
+        connectionErrors. Returns True if it's worth another try.
+        """
+        if self.pool is None:
+            return True # all we can do is try again
+        if (cur is not None or self.inTransaction
+            or self.pool.isHealthy(self._dbc)):
+            # a real error, or we'd lose the cursor or the transaction
+            return False
+        dbc, self._dbc, self._cur = self._dbc, None, None
+        self.pool.discard(dbc)
+        return True
+
+    def _execute(self, sql, params=None, many=False, cur=None):
         
+        if self.instrument is not None:
+            started = time.time()
         self.maxAttempts = 3
         attempt = 0
-        if MySQLdb:
-            theException = MySQLdb.OperationalError
-        else:
-            theException = NotImplementedError # hack!
-            
         while attempt < self.maxAttempts:
+            theCur = self.cur if cur is None else cur
             try:
                 #print sql
-                self.cur.execute(sql)
+                if many:
+                    theCur.executemany(sql, params)
+                elif params is None:
+                    theCur.execute(sql)
+                else:
+                    theCur.execute(sql, params)
                 break
-            except theException as e:
+            except self.connectionErrors as e:
                 # OperationalError: usually means the db is down.
                 attempt += 1
                 if attempt >= self.maxAttempts:
                     raise Exception("couldn't connect after %s tries: %s"
                                     % (attempt, e))
-                if attempt >= self.maxAttempts:
-                    raise 
+                if not self._reconnect(cur):
+                    raise Exception(str(e) + ":" + sql)
             except Exception as e:
                 raise Exception(str(e) + ":" + sql)
+        if self.instrument is not None:
+            # (_match fills in the row count for selects)
+            self._event = self._record(sql, params, started, theCur.rowcount)
 
 
 class PySQLiteStorage(MySQLStorage):
 
+    placeholder = "?"
+    noLimit = -1
+    setTypes = frozenset() # sqlite never returns sets
+    connectionErrors = ((sqlite.OperationalError, sqlite.ProgrammingError)
+                        if sqlite else ())
+
     def _getInsertID(self):
         return self.cur.lastrowid
 
-    def _execute(self, sql):
-        super(PySQLiteStorage, self)._execute(sql)
-        self.dbc.commit()
+    def begin(self):
+        # the sqlite module opens its own transaction on the next
+        # write; we just have to stop committing after each one.
+        self.inTransaction = True
+
+    # sqlite steps through the results as we fetch them, and
+    # other cursors can use the connection in the meantime:
+    streamsShareConnection = True
+
+    def _streamCursor(self, dbc):
+        return dbc.cursor()
+
+    def _execute(self, sql, params=None, many=False, cur=None):
+        super(PySQLiteStorage, self)._execute(sql, params, many, cur)
+        if not self.inTransaction:
+            self.dbc.commit()
+
+    def _insertMany(self, table, sql, params):
+        # sqlite doesn't set lastrowid after executemany(), but new
+        # rowids count up from the old maximum. We skip our own
+        # _execute (and its commit) until the end, so the whole
+        # thing happens in one transaction.
+        MySQLStorage._execute(self, sql, params, many=True)
+        MySQLStorage._execute(self, "SELECT max(rowid) FROM %s" % table)
+        last = self.cur.fetchone()[0]
+        self._execute("UPDATE %s SET ID=rowid WHERE ID IS NULL" % table)
+        return list(range(last - len(params) + 1, last + 1))
 
     def _insert_main(self, table, **row):
         id = super(PySQLiteStorage, self)._insert_main(table, **row)
-        self._execute("UPDATE %s SET ID=%s where ID IS NULL"
-                      % (table, id))
+        self._execute("UPDATE %s SET ID=? where ID IS NULL" % table, [id])
         return id
 
-    def close(self):
-        self.dbc.close()
+    def _reconnect(self, cur):
+        # without a pool, these are ordinary errors (no such table...)
+        return (self.pool is not None
+                and super(PySQLiteStorage, self)._reconnect(cur))
 
-    def commit(self):
-        self.dbc.commit()
+    def close(self):
+        if self.pool is not None:
+            self.release()
+        else:
+            self.dbc.close()
 
 
 if __name__ == "__main__":
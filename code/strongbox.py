@@ -15,10 +15,42 @@ _eggData = {
 
 Unspecified = object() # just a type distinct from None
 
+
+def _hook(kind):
+    """
+    Labels the stock onGet/onSet hooks, so MetaBox can tell
+    attr which classes it can skip them for.
+    """
+    def label(method):
+        method.kind = kind
+        return method
+    return label
+
+
+def _choices(okay):
+    """
+    Returns a membership test for the list okay,
+    using a set if the values can be hashed.
+    """
+    try:
+        choices = frozenset(okay)
+    except TypeError:
+        return okay.__contains__
+    def isOkay(value):
+        try:
+            return value in choices
+        except TypeError: # an unhashable value
+            return value in okay
+    return isOkay
+
+
 class attr(property):
     """
     A property that checks types
     """
+
+    _plain = False # (see setOkay)
+    _initial = Unspecified # (see initialValue)
     
     def __init__(self, typ, default=Unspecified, okay=None, allowNone=True):
         self.name = None
@@ -49,21 +81,25 @@ class attr(property):
     
     def setOkay(self, okay):
         """
-        Creates the data validation method isOkay
+        Creates the data validation method isOkay.
+        This happens once, when the class is built, so
+        regexps are compiled and lists become sets here.
         """
         self.okay = okay # keep for (eg) list dropdown forms
         def select(case=type(okay)):
             if str == case:
-                return lambda v : re.compile(okay).match(v)
+                return re.compile(okay).match
             elif LambdaType == case:
                 return okay
             elif list == case:
-                return okay.__contains__
+                return _choices(okay)
             elif okay is None:
                 return lambda v: True
             else:
                 raise TypeError(".okay cannot be %s" % case)
         self.isOkay = select()
+        # plain attrs can store a value of the exact type directly:
+        self._plain = okay is None and self.__class__ is attr
 
 
 
@@ -71,8 +107,15 @@ class attr(property):
         """
         BlackBox.__init__ uses return value for instance.private.xxx
         """
+        if self._initial is not Unspecified:
+            return self._initial
         self.forceLambda()
-        return self.attemptCast(self.default)
+        value = self.attemptCast(self.default)
+        if value is self.default:
+            # no cast was needed, so every instance gets this same
+            # object anyway. remember it rather than redo the work:
+            self._initial = value
+        return value
 
 
     def attemptCast(self, value):
@@ -137,7 +180,20 @@ class attr(property):
 
     ## getters and setters ##
 
+    # wrapSetter and wrapGetter take a shortcut when there's
+    # nothing for the full protocol to do: no validator, a value
+    # that's already the right type, and no observers/injectors.
+
     def wrapSetter(self, instance, value):
+        if self._plain and type(value) is self.type:
+            hook, pri = instance._setHook, instance.private
+            if hook == 'none':
+                setattr(pri, self.name, value)
+                return
+            if hook == 'observe' and not pri.observers:
+                setattr(pri, self.name, value)
+                pri.isDirty = True
+                return
         self.setter(instance, value)
 
     def setter(self, instance, value):
@@ -146,6 +202,10 @@ class attr(property):
         instance.onSet(self.name, val)
 
     def wrapGetter(self, instance):
+        hook = instance._getHook
+        if hook == 'none' or (hook == 'inject'
+                              and not instance.private.injectors):
+            return getattr(instance.private, self.name)
         return self.getter(instance)
     
     def getter(self, instance):
@@ -226,14 +286,35 @@ class Private(object):
     """
     A plain old object. Holds private data for its owner.
     """
-    
+    __slots__ = ('__dict__',) # so subclasses can add real slots
+    _fields = () # the real slots, if any
+
+    # (pickle and copy can't see slots by themselves)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in self._fields:
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+# the fields Strict and its mix-ins keep in .private:
+_bookkeeping = ('isDirty', 'isStub', 'observers', 'injectors')
+
 
 class Strict(object):
     """
     Strict objects contain a .private sub-object
     """
+    _Private = Private # MetaBox makes a slotted one for each class
+
     def __init__(self, **kwargs):
-        self.private = Private()
+        self.private = self._Private()
         
 
 
@@ -243,19 +324,22 @@ class Observable(Strict):
     """
     def __init__(self, **kw):
         super(Observable, self).__init__(**kw)
-        self.private.observers = []
+        self.private.observers = None # until someone subscribes
 
     def addObserver(self, callback):
+        if self.private.observers is None:
+            self.private.observers = []
         self.private.observers.append(callback)
 
     def removeObserver(self, callback):
-        if callback in self.private.observers:
+        if self.private.observers and callback in self.private.observers:
             self.private.observers.remove(callback)
         
     def notifyObservers(self, slot, value):
-        for callback in self.private.observers:
+        for callback in self.private.observers or ():
             callback(self, slot, value)
 
+    @_hook('observe')
     def onSet(self, slot, value):
         self.notifyObservers(slot, value)
         self.private.isDirty = True
@@ -269,19 +353,22 @@ class Injectable(Strict):
     def __init__(self, **kw):
         super(Injectable, self).__init__(**kw)
         self.private.isDirty = True # so new objects get saved
-        self.private.injectors = []
+        self.private.injectors = None # until someone subscribes
 
     def addInjector(self, callback):
+        if self.private.injectors is None:
+            self.private.injectors = []
         self.private.injectors.append(callback)
 
     def removeInjector(self, callback):
-        if callback in self.private.injectors:
+        if self.private.injectors and callback in self.private.injectors:
             self.private.injectors.remove(callback)
 
     def notifyInjectors(self, slot):
-        for callback in self.private.injectors:
+        for callback in self.private.injectors or ():
             callback(self, slot)
 
+    @_hook('inject')
     def onGet(self, slot):
         self.notifyInjectors(slot)
     
@@ -308,6 +395,9 @@ class MetaBox(type):
         klass.tellAttributesTheirNames()
         klass.addAccessors()
         klass.addCalculatedFields()
+        klass.buildSlotTables()
+        klass.buildPrivateRecord()
+        klass.findHooks()
         
     def tellAttributesTheirNames(klass):
         # this is so attrs can report their
@@ -354,36 +444,89 @@ class MetaBox(type):
                     elif name.startswith("set_"):
                         setter[slot] = klass.dict[name]
 
-        for key in set(getter.keys() + setter.keys()):
+        for key in set(getter) | set(setter):
             setattr(klass, key, property(getter.get(key), setter.get(key)))
-                    
 
-
-class BlackBox(Strict):
+    def buildSlotTables(klass):
+        """
+        Precomputes the (name, attribute) tables behind getSlots,
+        getSlotsOfType and listWritableSlots, so the instances
+        don't have to walk the class hierarchy every time.
+        """
+        found = {}
+        for base in klass.__mro__:
+            for slot, theAttr in base.__dict__.items():
+                found.setdefault(slot, theAttr) # subclasses win
+        klass._slots = tuple(sorted(
+            (slot, theAttr) for slot, theAttr in found.items()
+            if isinstance(theAttr, property)))
+        klass._slotsOfType = dict(
+            (t, tuple((slot, a) for slot, a in klass._slots
+                      if isinstance(a, t)))
+            for t in (attr, link, linkset))
+        klass._writableSlots = tuple(slot for slot, a in klass._slots
+                                     if a.fset is not None)
+        klass._plainAttrs = tuple(slot for slot, a in klass._slots
+                                  if a.__class__ == attr)
+
+    def buildPrivateRecord(klass):
+        """
+        Generates klass._Private, a Private with __slots__ for
+        the attributes and the bookkeeping fields, so instances
+        don't each carry a __dict__ for their private data.
+        (Anything else put in .private still works: it goes in
+        a __dict__ that's only created when first needed.)
+        """
+        names = set(slot for slot, a in klass._slotsOfType[attr])
+        names.update(_bookkeeping)
+        fields = tuple(sorted(names))
+        klass._Private = type(klass.__name__ + "Private", (Private,), {
+            "__slots__": fields,
+            "_fields": fields,
+            "__module__": klass.__module__,
+            # so pickle can find it (as klass._Private):
+            "__qualname__": getattr(klass, "__qualname__",
+                                    klass.__name__) + "._Private"})
+
+    def findHooks(klass):
+        """
+        Records which stock onGet/onSet hooks klass uses (if any),
+        so attr can skip them when they have nothing to do.
+        """
+        klass._getHook = getattr(getattr(klass, "onGet", None), "kind", None)
+        klass._setHook = getattr(getattr(klass, "onSet", None), "kind", None)
+
+
+
+# this is just __metaclass__=MetaBox, spelled so that
+# both python 2 and python 3 will pay attention to it:
+_MetaBoxBase = MetaBox("_MetaBoxBase", (Strict,), {})
+
+class BlackBox(_MetaBoxBase):
     """
     A class whose slots are all typed properties
     """
-    __metaclass__=MetaBox
 
     def __init__(self, **kwargs):
         super(BlackBox, self).__init__()
-        for name, attr in self.getSlots():
-            if type(attr) == property: continue
-            setattr(self.private, name, attr.initialValue(self))
+        for name, theAttr in self._slotsOfType[attr]:
+            setattr(self.private, name, theAttr.initialValue(self))
 
     def __setattr__(self, slot, value):
-        def fail(reason):
-            raise AttributeError("can't set attribute %s on %s instance: %s" %
-                                 (slot, self.__class__.__name__, reason))
         # for some reason, hasattr(self, slot) causes problems for injectors
         # i'm not sure why. in any case, this will do for now.
         if slot == "private" or hasattr(self.__class__, slot):
             try:
-                super(BlackBox, self).__setattr__(slot, value)
+                # (nothing between here and object overrides this)
+                object.__setattr__(self, slot, value)
             except AttributeError as e:
-                fail(str(e))
+                self._cantSet(slot, str(e))
         else:
-            fail('not a member of this class')
+            self._cantSet(slot, 'not a member of this class')
+
+    def _cantSet(self, slot, reason):
+        raise AttributeError("can't set attribute %s on %s instance: %s" %
+                             (slot, self.__class__.__name__, reason))
 
     def update(self, **kwargs):
         """
@@ -403,12 +546,14 @@ class BlackBox(Strict):
 
     ## accessor hooks ##
 
+    @_hook('none')
     def onSet(self, slot, value):
         """
         onSet hook. Does nothing in BlackBox.
         """
         pass
     
+    @_hook('none')
     def onGet(self, slot):
         """
         onGet hook. Does nothing in BlackBox.
@@ -427,37 +572,36 @@ class BlackBox(Strict):
                                       for a,v in self.attributeValues().items()]))
 
 
-    def getSlots(self):
+    @classmethod
+    def getSlots(klass):
         """
-        Returns a list of all name, attribute pairs.
+        Returns a tuple of all name, attribute pairs.
         """
-        myClass = self.__class__
-        return sorted([(slot, theAttr)                   
-                       for klass in (myClass,) + myClass.__bases__
-                       for slot, theAttr in klass.__dict__.items()
-                       if isinstance(theAttr, property)])
+        return klass._slots
 
 
-    def getSlotsOfType(self, t):
+    @classmethod
+    def getSlotsOfType(klass, t):
         """
-        Returns a list of all name, attribute pairs of type t
+        Returns a tuple of all name, attribute pairs of type t
         where t can be attr, link, linkset...
         """
-        return [(slot, attr) for (slot, attr) in self.getSlots()
-                if isinstance(attr, t)]
+        if t in klass._slotsOfType:
+            return klass._slotsOfType[t]
+        return tuple((slot, a) for (slot, a) in klass._slots
+                     if isinstance(a, t))
 
-    def listWritableSlots(self):
-        return [slot for (slot, attr) in self.getSlots()
-                if attr.fset is not None]
+    @classmethod
+    def listWritableSlots(klass):
+        return list(klass._writableSlots)
 
     def attributeValues(self):
         """
         Return a dictionary
         """
         res = {}
-        for name, prop in self.getSlots():
-            if prop.__class__ == attr:
-                res[name] = getattr(self, name)
+        for name in self._plainAttrs:
+            res[name] = getattr(self, name)
         return res
 
          
@@ -1,7 +1,37 @@
 import arlo
 from arlo import Expr, DotExpr, CallExpr, Name, Const, transform
+from arlo import InExpr, BetweenExpr, IsNullExpr, ChainExpr
+from arlo import structure, shape, walk
+from collections import OrderedDict
 from warnings import warn
 from copy import deepcopy
+import operator
+import re
+
+
+class ShapeCache(OrderedDict):
+    """
+    A least-recently-used cache for things compiled
+    from expressions, keyed on arlo.structure/shape.
+    """
+    def __init__(self, maxSize=1000):
+        super(ShapeCache, self).__init__()
+        self.maxSize = maxSize
+
+    def lookup(self, key, build, *args):
+        """
+        Returns the value for key, calling build(*args) to make
+        it if it's not there. Either way, key becomes the most
+        recently used.
+        """
+        try:
+            value = self.pop(key)
+        except KeyError:
+            value = build(*args)
+            while len(self) >= self.maxSize:
+                self.popitem(last=False)
+        self[key] = value
+        return value
 
 
 class WhereExpr(arlo.StartExpr):
@@ -26,6 +56,12 @@ _sqlDispatch = {
               else '%s.%s' % (f(a), f(b))),
     CallExpr: lambda f, a, b: '%s(%s)' % (f(a), f(b)),
     #   SubExpr ?
+    ChainExpr: lambda f, o, terms: '(%s)' % (' %s ' % OPS.get(o, o)).join(f(t) for t in terms),
+    InExpr: (lambda f, a, b:
+             '(%s IN (%s))' % (f(a), ', '.join(f(x) for x in b)) if b
+             else '(1 = 0)'), # IN () isn't valid sql
+    BetweenExpr: lambda f, a, b: '(%s BETWEEN %s AND %s)' % (f(a), f(b[0]), f(b[1])),
+    IsNullExpr: lambda f, a, b: '(%s IS NULL)' % f(a),
     Name: lambda f, a: str(a),
     Const: (lambda f, a:
             (repr(a).replace('L', '') if type(a) == int else
@@ -49,6 +85,304 @@ def pyLike(f, a, b):
 _pyDispatch = deepcopy(_sqlDispatch)
 _pyDispatch[Expr] = lambda f, a, o, b: pyLike(f, a, b) if o == '%' else '(%s %s %s)' % (f(a), o, f(b))
 _pyDispatch[Const] = lambda f, a: repr(a)
+# and/or compile to one flat node, where a long run of &'s would
+# nest too deeply for python's compiler:
+_pyDispatch[ChainExpr] = (lambda f, o, terms:
+                          '(%s)' % (' %s ' % {'&': 'and', '|': 'or'}[o]).join(f(t) for t in terms))
+# python turns a constant set literal into a frozenset, so this is a hash lookup:
+_pyDispatch[InExpr] = (lambda f, a, b:
+                       '(%s in {%s})' % (f(a), ', '.join(f(x) for x in b)) if b
+                       else 'False')
+_pyDispatch[BetweenExpr] = lambda f, a, b: '(%s <= %s <= %s)' % (f(b[0]), f(a), f(b[1]))
+_pyDispatch[IsNullExpr] = lambda f, a, b: '(%s is None)' % f(a)
+
+# for data kept column by column, each column x is a sequence,
+# and the code runs inside a loop over the row numbers, _i:
+_columnDispatch = dict(_pyDispatch)
+_columnDispatch[Name] = lambda f, a: '%s[_i]' % a
+_columnDispatch[DotExpr] = (lambda f, a, b:
+                            f(b) if a.__class__ in (arlo.StartExpr, WhereExpr)
+                            else '%s.%s' % (f(a), b.op))
+
+
+_sqlCache = ShapeCache()
+_paramCache = ShapeCache()
+_pyCache = ShapeCache()
+_paramPyCache = ShapeCache()
+_columnCache = ShapeCache()
+
+
+# simplification ###################################
+
+# only comparisons fold for every type. arithmetic on
+# strings (say) doesn't mean the same thing in sql:
+_compare = {
+    '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le,
+    '>': operator.gt, '>=': operator.ge}
+_arithmetic = {
+    '+': operator.add, '-': operator.sub, '*': operator.mul}
+_numbers = (int, float)
+
+def _isNumber(value):
+    # (sql compares numbers like python does, but strings go by
+    # the collation, and bools aren't always numbers)
+    return isinstance(value, _numbers) and not isinstance(value, bool)
+
+TRUE, FALSE = Const(True), Const(False)
+
+
+def _fold(f, a, o, b, forSQL=False):
+    a, b = f(a), f(b)
+    if o in arlo._chainOps:
+        return _chain(o, [a, b], forSQL)
+    if isinstance(a, Const) and isinstance(b, Const):
+        try:
+            if o in _compare and not (forSQL and not (
+                    _isNumber(a.op) and _isNumber(b.op))):
+                return Const(_compare[o](a.op, b.op))
+            if (o in _arithmetic and isinstance(a.op, _numbers)
+                and isinstance(b.op, _numbers)):
+                return Const(_arithmetic[o](a.op, b.op))
+        except TypeError:
+            pass
+    return Expr(a, o, b)
+
+
+def _subject(term):
+    # the thing a predicate is about: x in (x == 1), x.isin(...), etc.
+    if term.__class__ in (Expr, InExpr, BetweenExpr, IsNullExpr):
+        return term.left
+    return term
+
+
+def _equalities(term):
+    # the values term allows, if it's (x == const) or x.isin(...)
+    if term.__class__ is InExpr:
+        return [c.op for c in term.right]
+    if (term.__class__ is Expr and term.op == '=='
+        and isinstance(term.right, Const)
+        and not isinstance(term.left, Const)):
+        return [term.right.op]
+    return None
+
+
+def _chain(o, terms, forSQL=False):
+    flat = []
+    for term in terms:
+        if term.__class__ is ChainExpr and term.op == o:
+            flat.extend(term.terms)
+        else:
+            flat.append(term)
+    # true & p -> p, false & p -> false (and vice versa for |)
+    kept, seen = [], set()
+    for term in flat:
+        if isinstance(term, Const):
+            if bool(term.op) == (o == '|'):
+                return Const(o == '|')
+            continue
+        key = structure(term)
+        if key not in seen:
+            seen.add(key)
+            kept.append(term)
+    if not forSQL: # (see simplifyForSQL)
+        if o == '|':
+            kept = _collectIns(kept)
+        elif _contradicts(kept):
+            return FALSE
+    if not kept:
+        return Const(o == '&')
+    if len(kept) == 1:
+        return kept[0]
+    return ChainExpr(o, kept)
+
+
+def _collectIns(terms):
+    # (x == 1) | (x == 2) | x.isin([3]) -> x.isin([1, 2, 3])
+    groups, order = {}, []
+    for term in terms:
+        values = _equalities(term)
+        key = structure(term.left) if values is not None else None
+        if key is None:
+            order.append(term)
+        else:
+            if key not in groups:
+                groups[key] = (term.left, [])
+                order.append(key)
+            groups[key][1].append((term, values))
+    res = []
+    for item in order:
+        if isinstance(item, Expr):
+            res.append(item)
+            continue
+        subject, members = groups[item]
+        if len(members) == 1:
+            res.append(members[0][0])
+            continue
+        values, seen = [], set()
+        try:
+            for term, vals in members:
+                for v in vals:
+                    if v not in seen:
+                        seen.add(v)
+                        values.append(v)
+        except TypeError: # unhashable
+            res.extend(term for term, vals in members)
+        else:
+            res.append(InExpr(subject, values))
+    return res
+
+
+def _contradicts(terms):
+    """
+    True if no row could match all the terms, eg:
+    (x == 1) & (x == 2) or (x > 5) & (x < 3)
+    """
+    columns = {}
+    for term in terms:
+        if term.__class__ not in (Expr, InExpr, BetweenExpr, IsNullExpr):
+            continue
+        if term.__class__ is Expr and not (term.op in _compare
+                                           and isinstance(term.right, Const)):
+            continue
+        columns.setdefault(structure(term.left), []).append(term)
+    for group in columns.values():
+        try:
+            if _impossible(group):
+                return True
+        except TypeError: # unhashable or unorderable values
+            pass
+    return False
+
+
+def _impossible(group):
+    allowed, checks = None, []
+    for term in group:
+        cls = term.__class__
+        if cls is IsNullExpr:
+            values = [None]
+        elif cls is BetweenExpr:
+            lo, hi = term.right[0].op, term.right[1].op
+            checks.append(('>=', lo))
+            checks.append(('<=', hi))
+            continue
+        else:
+            values = _equalities(term)
+            if values is None:
+                checks.append((term.op, term.right.op))
+                continue
+        allowed = set(values) if allowed is None else allowed & set(values)
+    if allowed is not None:
+        return not [v for v in allowed
+                    if all(_passes(v, o, c) for o, c in checks)]
+    lows = [(c, o == '>') for o, c in checks if o in ('>', '>=')]
+    highs = [(c, o == '<') for o, c in checks if o in ('<', '<=')]
+    for lo, strictLo in lows:
+        for hi, strictHi in highs:
+            if lo > hi or (lo == hi and (strictLo or strictHi)):
+                return True
+    return False
+
+
+def _passes(value, o, const):
+    try:
+        return _compare[o](value, const)
+    except TypeError:
+        return True # can't tell, so keep it
+
+
+_simpleDispatch = {
+    Expr: _fold,
+    ChainExpr: lambda f, o, terms: _chain(o, [f(t) for t in terms]),
+    InExpr: lambda f, a, b: InExpr(f(a), b) if b else FALSE,
+    BetweenExpr: lambda f, a, b: BetweenExpr(f(a), b[0], b[1]),
+    IsNullExpr: lambda f, a, b: IsNullExpr(f(a))}
+
+_sqlSimpleDispatch = dict(_simpleDispatch)
+_sqlSimpleDispatch[Expr] = lambda f, a, o, b: _fold(f, a, o, b, True)
+_sqlSimpleDispatch[ChainExpr] = (lambda f, o, terms:
+                                 _chain(o, [f(t) for t in terms], True))
+
+
+def _mightSimplify(ex):
+    """
+    Whether simplify could change anything. This only looks at
+    the shape of ex, so the answer is cached per shape and
+    the usual (x == ?) & (y == ?) queries skip the real work.
+    """
+    for node in walk(ex):
+        cls = node.__class__
+        if cls is Expr and (node.op in arlo._chainOps or
+                            isinstance(node.left, Const) and
+                            isinstance(node.right, Const)):
+            return True
+        if cls is InExpr and not node.right:
+            return True
+        if cls is ChainExpr:
+            subjects = set()
+            for term in node.terms:
+                if isinstance(term, Const) or term.__class__ is ChainExpr \
+                   and term.op == node.op:
+                    return True
+                key = shape(_subject(term))[0]
+                if key in subjects:
+                    return True
+                subjects.add(key)
+    return False
+
+
+_mightCache = ShapeCache()
+_simpleCache = ShapeCache()
+_sqlSimpleCache = ShapeCache()
+
+
+# Expr -> Expr
+def simplify(ex):
+    """
+    Returns an equivalent expression with the redundancy
+    taken out: constants are folded, duplicate terms are
+    dropped, (x == 1) | (x == 2) becomes x.isin([1, 2]),
+    and a clause that can't match anything, like
+    (x == 1) & (x == 2), becomes a false Const.
+
+    This goes by python's rules for comparing values, so
+    it's for expressions that python evaluates (toPython).
+    See simplifyForSQL for the ones a database evaluates.
+    """
+    return _simplify(ex, shape(ex)[0])
+
+def _simplify(ex, key):
+    if not _mightCache.lookup(key, _mightSimplify, ex):
+        return ex
+    return _simpleCache.lookup(structure(ex), transform,
+                               lambda x: x, _simpleDispatch, ex)
+
+
+def simplifyForSQL(ex):
+    """
+    Like simplify, but only does what holds in any database.
+    Databases compare values by their own rules (the column's
+    type, the collation...), so here only numbers are folded,
+    and it doesn't try to prove the clause can't match:
+    (age > "5") & (age < "10") is false in python, but not
+    for an int column in sqlite. Or-chains are left as they
+    are, too, rather than turned into an IN list.
+    """
+    return _simplifyForSQL(ex, shape(ex)[0])
+
+def _simplifyForSQL(ex, key):
+    if not _mightCache.lookup(key, _mightSimplify, ex):
+        return ex
+    return _sqlSimpleCache.lookup(structure(ex), transform,
+                                  lambda x: x, _sqlSimpleDispatch, ex)
+
+
+def isFalse(ex):
+    """
+    True if ex is a constant that's false, ie, if
+    simplify() proved it can't match any rows.
+    """
+    return isinstance(ex, Const) and not ex.op
 
 
 # Expr -> str
@@ -57,11 +391,143 @@ def toSQL(ex):
     generate sql from an arlo Expr
     (only does where clause for now)
     """
-    return transform(toSQL, _sqlDispatch, ex)
+    return _sqlCache.lookup(structure(ex), _toSimpleSQL, ex)
+
+def _toSimpleSQL(ex):
+    ex = simplifyForSQL(ex)
+    if isinstance(ex, Const) and type(ex.op) == bool:
+        return _ALWAYS if ex.op else _NEVER
+    return _toSQL(ex)
+
+# not every database has TRUE and FALSE:
+_ALWAYS, _NEVER = '(1 = 1)', '(1 = 0)'
+
+def _toSQL(ex):
+    return transform(_toSQL, _sqlDispatch, ex)
 
 
 sql = toSQL
 
 
+# (Expr, str) -> (str, [object])
+def toParamSQL(ex, marker="%s"):
+    """
+    like toSQL, but leaves a marker in place of each constant
+    and returns the values separately, for the db driver to bind:
+
+    toParamSQL(where.x == 5, '?') -> ('(x = ?)', [5])
+
+    The sql only depends on the shape of the expression, so
+    it's only generated once for each shape.
+    """
+    key, params = shape(ex)
+    simple = _simplifyForSQL(ex, key)
+    if simple is not ex:
+        if isinstance(simple, Const) and type(simple.op) == bool:
+            return _ALWAYS if simple.op else _NEVER, []
+        ex = simple
+        key, params = shape(ex)
+    return _paramCache.lookup((key, marker), _toParamSQL, ex, marker), params
+
+def _toParamSQL(ex, marker):
+    dispatch = dict(_sqlDispatch)
+    dispatch[Const] = lambda f, a: marker
+    def f(ex):
+        return transform(f, dispatch, ex)
+    return f(ex)
+
+
 def toPython(ex):
-    return transform(toPython, _pyDispatch, ex)
+    return _pyCache.lookup(structure(ex), _toSimplePython, ex)
+
+def _toSimplePython(ex):
+    return _toPython(simplify(ex))
+
+def _toPython(ex):
+    return transform(_toPython, _pyDispatch, ex)
+
+
+# Expr -> (str, {str: object})
+def toParamPython(ex):
+    """
+    like toPython, but names each constant (_p0, _p1...) instead
+    of writing it into the code, and returns the values separately,
+    to pass in as globals:
+
+    toParamPython(where.x == 5) -> ('(x == _p0)', {'_p0': 5})
+
+    The code only depends on the shape of the expression, so
+    where.x == 5 and where.x == 6 can share one compiled copy.
+    The constants in an isin() come back as one frozenset, and
+    x % const calls like(), since the code can't depend on
+    whether the constant is a pattern.
+    """
+    key, consts = shape(ex)
+    simple = _simplify(ex, key)
+    if simple is not ex:
+        ex = simple
+        key, consts = shape(ex)
+    code, slots = _paramPyCache.lookup(key, _toParamPython, ex)
+    return code, dict((name, consts[i] if j is None
+                       else frozenset(consts[i:j]))
+                      for name, (i, j) in slots.items())
+
+def _toParamPython(ex):
+    # transform() does the parts of each node left to right before
+    # the node itself, the same order shape() lists the constants
+    # in, so the nth Const we see is the nth value. slots maps each
+    # name to (n, None), or to (start, end) for an isin() set.
+    slots, seen = {}, [0]
+    def const(f, a):
+        name = '_p%d' % seen[0]
+        slots[name] = (seen[0], None)
+        seen[0] += 1
+        return name
+    def isin(f, a, b):
+        if not b:
+            return 'False'
+        names = [f(x) for x in b]
+        if not all(isinstance(x, Const) for x in b):
+            return '(%s in {%s})' % (f(a), ', '.join(names))
+        for name in names:
+            del slots[name]
+        slots[names[0]] = (seen[0] - len(b), seen[0])
+        return '(%s in %s)' % (f(a), names[0])
+    def expr(f, a, o, b):
+        if o == '%' and isinstance(b, Const):
+            return '_like(%s, %s)' % (f(a), f(b))
+        return '(%s %s %s)' % (f(a), o, f(b))
+    dispatch = dict(_pyDispatch)
+    dispatch.update({Const: const, InExpr: isin, Expr: expr})
+    def f(ex):
+        return transform(f, dispatch, ex)
+    return f(ex), slots
+
+def like(value, pattern):
+    """
+    value % pattern, as the code from toParamPython does it
+    (it's passed in as _like): sql's LIKE if the pattern is a
+    string, and python's mod operator otherwise.
+    """
+    if isinstance(pattern, str):
+        if pattern.endswith('%'): return value.startswith(pattern[:-1])
+        if pattern.startswith('%'): return value.endswith(pattern[1:])
+        return re.match(pattern, value)
+    # not a string, so assume it's a real mod operator
+    return value % pattern
+
+
+def toColumnPython(ex):
+    """
+    Like toPython, but each column x becomes x[_i], for
+    testing row _i of data that's stored column by column:
+
+    toColumnPython(where.x > 5) -> '(x[_i] > 5)'
+    """
+    return _columnCache.lookup(structure(ex), _toSimpleColumnPython, ex)
+
+def _toSimpleColumnPython(ex):
+    return _toColumnPython(simplify(ex))
+
+def _toColumnPython(ex):
+    return transform(_toColumnPython, _columnDispatch, ex)
@@ -1,4 +1,4 @@
-from arlo import _, declare, StartExpr, Name, pattern
+from arlo import _, declare, StartExpr, Name, pattern, structure, shape
 import unittest
 
 
@@ -28,6 +28,41 @@ class ArloTest(unittest.TestCase):
         """
         assert type(_(0) < _(1)) != bool
 
+    def test_structure(self):
+        # == builds expressions, so use sameAs() or structure():
+        assert ((_.x == 1) & (_.y < 'a')).sameAs((_.x == 1) & (_.y < 'a'))
+        assert not (_.x == 1).sameAs(_.x == 2)
+        assert not (_.x == 1).sameAs(_.x == True)
+        d = {structure(_.f(_.x, [1])): "ok"}
+        self.assertEquals("ok", d[structure(_.f(_.x, [1]))])
+
+        key, consts = shape((_.x == 1) & (_.y < 'a'))
+        self.assertEquals([1, 'a'], consts)
+        self.assertEquals(key, shape((_.x == 2) & (_.y < 'b'))[0])
+
+    def test_reserved(self):
+        # the predicate methods can't double as names:
+        self.want(_.x.isnull(), "_.x.isnull()", repr)
+        for name in ["isin", "between", "isnull", "sameAs"]:
+            self.assertRaises(NameError, getattr, _, name)
+        self.assertEquals("isnull", str(Name("isnull")))
+
+    def test_chains(self):
+        # & and | chains are flattened into one node:
+        ex = _.a & _.b & (_.c & _.d)
+        self.assertEquals(4, len(ex.terms))
+        self.want(ex, "(a & b & c & d)")
+        self.want(ex.left, "(a & b & c)")
+        self.want(ex.right, "d")
+        # ... but mixed operators are not:
+        self.want((_.a & _.b) | _.c, "((a & b) | c)")
+        # chains that share a prefix don't step on each other:
+        ab = _.a & _.b
+        abc, abd = ab & _.c, ab & _.d
+        self.want(ab, "(a & b)")
+        self.want(abc, "(a & b & c)")
+        self.want(abd, "(a & b & d)")
+
     def test_Const(self):
         self.want(_(5), "5")
 
@@ -0,0 +1,92 @@
+from boxpack import *
+from strongbox import StrongBox, attr, link, linkset
+from pytypes import Date
+import unittest
+
+
+class Folder(StrongBox):
+    ID = attr(int)
+    name = attr(str)
+    made = attr(Date)
+    parent = link(lambda: Folder)
+    kids = linkset(lambda: Folder, "parent")
+
+
+class BoxPackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.top = Folder(ID=1, name="top", made=Date("2010-01-02"))
+        for n in range(2):
+            self.top.kids << Folder(ID=n + 2, name="kid%s" % n)
+
+    def check(self, top):
+        self.assertEquals("top", top.name)
+        assert isinstance(top.made, Date)
+        self.assertEquals(str(Date("2010-01-02")), str(top.made))
+        self.assertEquals(["kid0", "kid1"], [k.name for k in top.kids])
+        # the backlinks point at the same object, not a copy:
+        for kid in top.kids:
+            assert kid.parent is top
+        assert top.parent is None
+
+    def test_binary(self):
+        data = pack(self.top)
+        assert isinstance(data, bytes)
+        self.check(unpack(data, [Folder]))
+
+    def test_json(self):
+        self.check(fromJSON(toJSON(self.top), [Folder]))
+
+    def test_shared(self):
+        a, b = self.top.kids
+        a.private.isDirty = False
+        x, y, top = unpack(pack([a, b, self.top]), [Folder])
+        assert x.parent is y.parent is top
+        assert not x.private.isDirty
+        assert y.private.isDirty
+
+    def test_layout_changes(self):
+        payload = dump(self.top)
+        payload[1][0][1].append("retired") # an attr that's gone now
+        for record in payload[2]:
+            record.insert(2 + 3, "whatever")
+        self.check(load(payload, [Folder]))
+
+        # and links and linksets the payload doesn't know about
+        # (added since it was written) get their defaults:
+        payload = dump(self.top)
+        payload[1][0][2:] = [[], []]
+        for record in payload[2]:
+            del record[2 + 3:]
+        top = load(payload, [Folder])
+        assert top.parent is None
+        self.assertEquals([], list(top.kids))
+        top.kids << Folder(name="new")
+        assert top.kids[0].parent is top
+
+    def test_clerk_boxes(self):
+        from clerks import Clerk, Schema
+        from storage import RamStorage
+        clerk = Clerk(RamStorage(), Schema({Folder: "folder",
+                                            Folder.parent: "parentID"}))
+        top = Folder(name="top", made=Date("2010-01-02"))
+        for n in range(2):
+            top.kids << Folder(name="kid%s" % n)
+        clerk.store(top)
+        clerk = Clerk(clerk.storage, clerk.schema)
+        # the kids aren't loaded until you ask, so dump asks:
+        top = clerk.fetch(Folder, top.ID)
+        self.check(unpack(pack(top), [Folder]))
+
+    def test_long_chain(self):
+        last = head = Folder(ID=0)
+        for n in range(5000):
+            last.kids << Folder(ID=n + 1)
+            last = last.kids[0]
+        again = unpack(pack(head), [Folder])
+        self.assertEquals(0, again.ID)
+        self.assertEquals(1, again.kids[0].ID)
+
+
+if __name__=="__main__":
+    unittest.main()
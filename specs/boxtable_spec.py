@@ -0,0 +1,82 @@
+from boxtable import *
+from strongbox import StrongBox, attr
+from wherewolf import where
+import unittest
+from array import array
+
+
+class Sale(StrongBox):
+    ID = attr(int)
+    item = attr(str)
+    qty = attr(int)
+    price = attr(float)
+
+
+class BoxTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.made = []
+        def makeBox(row):
+            self.made.append(row["ID"])
+            return Sale(**row)
+        self.table = BoxTable(Sale, [
+            {"ID": 1, "item": "apple", "qty": 3, "price": 0.5},
+            {"ID": 2, "item": "pear", "qty": 1, "price": 0.75},
+            {"ID": 3, "item": "apple", "qty": "2", "price": 0.5},
+            {"ID": 4, "item": "fig", "qty": 5, "price": 1.25}], makeBox)
+
+    def test_columns(self):
+        qty = self.table.column("qty")
+        assert isinstance(qty, array)
+        self.assertEquals([3, 1, 2, 5], list(qty)) # "2" was cast
+        assert isinstance(self.table.column("price"), array)
+        self.assertEquals(["apple", "pear", "apple", "fig"],
+                          self.table.column("item"))
+        # a None doesn't fit in an array, so the column becomes a list:
+        self.table.append({"ID": 5, "item": "kiwi", "qty": None})
+        self.assertEquals([3, 1, 2, 5, None], self.table.column("qty"))
+        self.assertEquals(5, len(self.table))
+
+    def test_lazy_boxes(self):
+        self.assertEquals(4, len(self.table))
+        self.assertEquals([], self.made)
+        sale = self.table[2]
+        self.assertEquals([3], self.made)
+        assert isinstance(sale, Sale)
+        self.assertEquals(2, sale.qty)
+        assert self.table[-2] is sale
+        self.assertEquals(["pear", "fig"],
+                          [s.item for s in self.table[1::2]])
+
+    def test_filter(self):
+        apples = self.table.filter(item="apple")
+        self.assertEquals([1, 3], list(apples.column("ID")))
+        cheap = self.table.filter((where.price < 1) & (where.qty > 1))
+        self.assertEquals([1, 3], list(cheap.column("ID")))
+        self.assertEquals([2, 4], list(self.table.filter(
+            where.item.isin(["pear", "fig"])).column("ID")))
+        self.assertEquals([], self.made) # no boxes needed
+
+    def test_sort(self):
+        self.table.append({"ID": 5, "item": "kiwi", "qty": None})
+        self.assertEquals([5, 2, 3, 1, 4],
+                          list(self.table.sort("qty").column("ID")))
+        self.assertEquals([1, 3, 4, 5, 2],
+                          list(self.table.sort("item, qty desc").column("ID")))
+
+    def test_totals(self):
+        self.assertEquals(11, self.table.sum("qty"))
+        self.assertEquals(1, self.table.min("qty"))
+        self.assertEquals(1.25, self.table.max("price"))
+        self.assertEquals(0.75, self.table.average("price"))
+        self.table.append({"ID": 5, "item": "kiwi", "qty": None})
+        self.assertEquals(5, self.table.count())
+        self.assertEquals(4, self.table.count("qty"))
+        self.assertEquals(11, self.table.sum("qty"))
+        groups = self.table.groupBy("item")
+        self.assertEquals(["apple", "pear", "fig", "kiwi"], list(groups))
+        self.assertEquals(5, groups["apple"].sum("qty"))
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -3,7 +3,7 @@ from narrative import testcase, addMethod
 from strongbox import *
 from unittest import TestCase
 from clerks import *
-from storage import RamStorage
+from storage import RamStorage, StatementLog
 import unittest
 
 # * Clerk: Executive Overview
@@ -256,6 +256,157 @@ def test_store_linksets(self):
     assert len(n.kids) == 1
 
 
+# ** storing lots of objects at once
+"""
+store() writes one row at a time, and reads each new row back.
+For imports, storeMany() writes the dirty objects in the graph
+with one batched insert or update per table for each level of
+link dependency.
+"""
+@testcase
+def test_storeMany(self):
+
+    class CountingStorage(RamStorage):
+        def insertMany(self, table, rows):
+            self.calls.append(("insert", table, len(rows)))
+            return RamStorage.insertMany(self, table, rows)
+        def updateMany(self, table, rows):
+            self.calls.append(("update", table, len(rows)))
+            return RamStorage.updateMany(self, table, rows)
+
+    storage = CountingStorage()
+    storage.calls = []
+    clerk = Clerk(storage, TEST_SCHEMA)
+
+    top = Node(data="top")
+    for x in "abc":
+        kid = Node(data=x)
+        top.kids << kid
+        kid.kids << Node(data=x + x)
+    rec = Record(value="1", next=Record(value="2", next=Record(value="3")))
+
+    clerk.storeMany([top, rec])
+
+    # the parent has to go first, then the kids, then the grandkids,
+    # and the linked records go in reverse order:
+    self.assertEquals([("insert", NODE_TABLE, 1), ("insert", RECORD_TABLE, 1),
+                       ("insert", NODE_TABLE, 3), ("insert", RECORD_TABLE, 1),
+                       ("insert", NODE_TABLE, 3), ("insert", RECORD_TABLE, 1)],
+                      storage.calls)
+
+    assert not top.private.isDirty
+    assert clerk.cache[(Node, top.ID)] is top
+    self.assertEquals(top.ID, storage.fetch(NODE_TABLE, top.kids[0].ID)["parentID"])
+    aa = top.kids[0].kids[0]
+    self.assertEquals(top.kids[0].ID, storage.fetch(NODE_TABLE, aa.ID)["parentID"])
+    self.assertEquals(rec.next.ID, storage.fetch(RECORD_TABLE, rec.ID)["nextID"])
+
+    # only dirty objects get written, and old ones are updated:
+    del storage.calls[:]
+    top.kids[1].data = "B"
+    top.kids[2].data = "C"
+    clerk.storeMany([top])
+    self.assertEquals([("update", NODE_TABLE, 2)], storage.calls)
+    self.assertEquals("C", storage.fetch(NODE_TABLE, top.kids[2].ID)["data"])
+
+    # a cycle among new objects can't be written in one pass, so
+    # the link that closes it gets filled in afterwards:
+    a = Record(value="a")
+    b = Record(value="b", next=a)
+    a.next = b
+    clerk.storeMany([a])
+    self.assertEquals(b.ID, storage.fetch(RECORD_TABLE, a.ID)["nextID"])
+    self.assertEquals(a.ID, storage.fetch(RECORD_TABLE, b.ID)["nextID"])
+
+
+# ** sessions: a unit of work
+"""
+A session collects everything you change or store inside a
+with-block, and writes it all with storeMany() in one transaction
+when the block ends. If the block raises an exception, nothing
+gets written.
+"""
+@testcase
+def test_session(self):
+
+    storage = RamStorage()
+    clerk = Clerk(storage, TEST_SCHEMA)
+    clerk.store(Record(value="old"))
+
+    with clerk.session() as s:
+        rec = s.fetch(Record, 1)
+        rec.value = "changed"           # watched through its observers
+        clerk.store(Record(value="new")) # the clerk defers to the session
+        self.assertEquals("old", storage.fetch(RECORD_TABLE, 1)["value"])
+        self.assertEquals(1, len(storage.match(RECORD_TABLE)))
+
+    self.assertEquals(["changed", "new"],
+                      [r["value"] for r in storage.match(RECORD_TABLE)])
+    assert not rec.private.isDirty
+    assert clerk._session is None
+
+    # an exception throws the whole unit of work away:
+    try:
+        with clerk.session() as s:
+            rec.value = "lost"
+            s.store(Record(value="lost"))
+            raise ValueError("oops")
+    except ValueError:
+        pass
+    self.assertEquals(["changed", "new"],
+                      [r["value"] for r in storage.match(RECORD_TABLE)])
+
+    # deletes wait for the end of the block, so they get thrown away too:
+    try:
+        with clerk.session() as s:
+            clerk.delete(Record, rec.ID)
+            self.assertEquals(2, len(storage.match(RECORD_TABLE)))
+            raise ValueError("oops")
+    except ValueError:
+        pass
+    self.assertEquals(2, len(storage.match(RECORD_TABLE)))
+    assert clerk.fetch(Record, rec.ID) is rec
+
+    with clerk.session() as s:
+        s.delete(Record, rec.ID)
+    self.assertEquals(["new"], [r["value"] for r in storage.match(RECORD_TABLE)])
+
+    # if the flush itself fails, the objects are left as they were,
+    # and the session still has the work, so you can try again:
+    class FlakyStorage(RamStorage):
+        fail = True
+        def updateMany(self, table, rows):
+            if self.fail:
+                raise IOError("disk full")
+            return RamStorage.updateMany(self, table, rows)
+    storage = FlakyStorage()
+    clerk = Clerk(storage, TEST_SCHEMA)
+    a = Record(value="a")
+    a.next = Record(value="b", next=a) # a cycle, so there's an update
+    unit = clerk.session()
+    try:
+        with unit:
+            clerk.store(a)
+    except IOError:
+        pass
+    self.assertEquals([], storage.match(RECORD_TABLE))
+    for box in [a, a.next]:
+        assert not box.ID
+        assert box.private.isDirty
+    self.assertEquals([], list(clerk.cache.data.get(Record, {}).keys()))
+    storage.fail = False
+    unit.flush()
+    self.assertEquals(["a", "b"],
+                      sorted(r["value"] for r in storage.match(RECORD_TABLE)))
+    assert clerk.fetch(Record, a.ID) is a
+    assert not a.private.isDirty
+
+    # and after the session, changes aren't tracked anymore:
+    assert not rec.private.observers or \
+           all(getattr(o, "__self__", None) is not s
+               for o in rec.private.observers)
+
+
 # * fetching objects
 
 @addMethod(ClerkTest)
@@ -341,6 +492,145 @@ def test_match(self):
 # @TODO: ought to have a test case about where/arlo
 
 
+# ** streaming big results
+"""
+match() builds the whole list at once. iterMatch() yields the
+objects as the rows come in, so with a bounded cache you can
+walk a huge table in constant memory.
+"""
+@testcase
+def test_iterMatch(self):
+    storage = RamStorage()
+    for i, word in enumerate("one two three".split()):
+        storage.store(RECORD_TABLE, value=word, nextID=i or None)
+    clerk = Clerk(storage, TEST_SCHEMA, cache=Cache(WeakPolicy()))
+    recs = clerk.iterMatch(Record, where.ID > 1)
+    assert not isinstance(recs, list)
+    # the objects can load their links as we go, since the storage
+    # lets other queries run while it streams (see storage_spec):
+    self.assertEquals([("two", "one"), ("three", "two")],
+                      [(r.value, r.next.value) for r in recs])
+
+    # statements run while the rows stream in are labelled
+    # iterMatch (see test_statement_log), but the ones we run
+    # inside the loop aren't:
+    class StreamingStorage(RamStorage):
+        def iterMatch(self, table, *args, **kwargs):
+            for row in RamStorage.iterMatch(self, table, *args, **kwargs):
+                self.labels.append(self.operation)
+                yield row
+    storage = StreamingStorage()
+    storage.labels = []
+    for word in "one two three".split():
+        storage.store(RECORD_TABLE, value=word)
+    clerk = Clerk(storage, TEST_SCHEMA)
+    for rec in clerk.iterMatch(Record, where.ID > 1):
+        self.assertEquals(None, storage.operation)
+    self.assertEquals(["iterMatch", "iterMatch"], storage.labels)
+
+
+# ** columnar results
+"""
+For reports over lots of rows, matchTable() returns a BoxTable
+(see boxtable_spec) instead of a list. The rows are kept column
+by column, and objects are only built for the rows you look at.
+"""
+@testcase
+def test_matchTable(self):
+    storage = RamStorage()
+    for word in "one two three".split():
+        storage.store(RECORD_TABLE, value=word)
+    clerk = Clerk(storage, TEST_SCHEMA)
+    table = clerk.matchTable(Record, where.ID > 1, orderBy="value")
+    self.assertEquals(2, len(table))
+    self.assertEquals(["three", "two"], list(table.column("value")))
+    self.assertEquals(5, table.sum("ID"))
+    assert clerk.cache.get(Record, 3) is None
+    rec = table[0]
+    self.assertEquals("three", rec.value)
+    assert rec is clerk.fetch(Record, 3)
+    assert table[0] is rec
+
+    # unsaved changes count, just like they do for match():
+    rec.value = "THREE"
+    table = clerk.matchTable(Record, where.ID > 1, orderBy="value")
+    self.assertEquals(["THREE", "two"], list(table.column("value")))
+    self.assertEquals([r.value for r in clerk.match(Record, where.ID > 1,
+                                                    orderBy="value")],
+                      [r["value"] for r in table.rows()])
+    self.assertEquals("three", storage.fetch(RECORD_TABLE, 3)["value"])
+
+
+# ** pages and projections
+"""
+For list views, you often want a page of results, and only a
+few of the columns. match() takes limit, offset, and columns.
+With columns, new objects come back as stubs: the slots you
+asked for are filled in, and the rest load when you touch them.
+"""
+@testcase
+def test_match_page(self):
+
+    class CountingStorage(RamStorage):
+        def fetch(self, table, ID):
+            self.fetches += 1
+            return RamStorage.fetch(self, table, ID)
+
+    storage = CountingStorage()
+    storage.fetches = 0
+    for i, word in enumerate("one two three four five".split()):
+        storage.store(RECORD_TABLE, value=word, nextID=i or None)
+    clerk = Clerk(storage, TEST_SCHEMA)
+
+    page = clerk.match(Record, orderBy="value", limit=2, offset=1)
+    self.assertEquals(["four", "one"], [r.value for r in page])
+    # a page doesn't mean we have the whole table:
+    assert Record not in clerk.cache.allCached
+
+    # once the whole class is cached, pages still come back sorted:
+    clerk.match(Record)
+    assert Record in clerk.cache.allCached
+    page = clerk.match(Record, orderBy="value", limit=2, offset=1)
+    self.assertEquals(["four", "one"], [r.value for r in page])
+    self.assertEquals(["two", "three"],
+                      [r.value for r in clerk.match(Record, orderBy="value desc",
+                                                   limit=2)])
+
+    clerk = Clerk(storage, TEST_SCHEMA)
+    recs = clerk.match(Record, where.ID > 3, columns=["value", "next"])
+    self.assertEquals(["four", "five"], [r.value for r in recs])
+    assert recs[0].next is clerk.cache.get(Record, 3)
+    self.assertEquals(0, storage.fetches)
+
+    # touching anything else loads the rest:
+    recs[0].next.value
+    self.assertEquals(1, storage.fetches)
+    self.assertEquals("three", recs[0].next.value)
+
+    # and changes to partial objects are kept:
+    recs[1].value = "FIVE"
+    clerk.store(recs[1])
+    self.assertEquals({"ID":5, "value":"FIVE", "nextID":4},
+                      storage.fetch(RECORD_TABLE, 5))
+
+    # the columns come back as the slots' types, just like
+    # they do when the whole row is loaded:
+    from pytypes import Date
+    class Event(Strongbox):
+        ID = attr(int)
+        active = attr(bool)
+        day = attr(Date)
+        count = attr(int)
+    storage = RamStorage()
+    storage.store("event", active=1, day="2020-01-02", count="5")
+    schema = Schema({Event: "event"})
+    part = Clerk(storage, schema).match(Event, columns=["active", "day", "count"])[0]
+    full = Clerk(storage, schema).fetch(Event, 1)
+    for name in ["active", "day", "count"]:
+        self.assertEquals(type(getattr(full, name)), type(getattr(part, name)))
+        self.assertEquals(str(getattr(full, name)), str(getattr(part, name)))
+
+
 @addMethod(ClerkTest)
 def test_matchOne(self):
     self.clerk.store(Record(value="one"))
@@ -691,6 +981,81 @@ def test_linkinjector_with_linkset(self):
     self.assertEquals("Brother Dad", unc.brother.name)
 
 
+# ** prefetching links and linksets
+"""
+Lazy loading is great for one object, but if you loop through
+a list of 500 objects and touch a link on each one, every stub
+fires its own query. Passing prefetch=[...] to match() loads
+the named links and linksets for the whole result set at once.
+"""
+@testcase
+def test_prefetch(self):
+
+    class CountingStorage(RamStorage):
+        def _match(self, table, *args, **kwargs):
+            self.queries.append(table)
+            return RamStorage._match(self, table, *args, **kwargs)
+
+    storage = CountingStorage()
+    storage.queries = []
+    clerk = Clerk(storage, TEST_SCHEMA)
+
+    storage.store(NODE_TABLE, data="top", parentID=None)
+    for i in range(5):
+        storage.store(NODE_TABLE, data="kid%s" % i, parentID=1)
+    for i in range(5):
+        storage.store(NODE_TABLE, data="grandkid%s" % i, parentID=i+2)
+
+    kids = clerk.match(Node, parentID=1, prefetch=["parent", "kids"])
+    self.assertEquals(3, len(storage.queries))
+
+    # now none of these should hit the storage:
+    assert all(k.parent.data == "top" for k in kids)
+    self.assertEquals(["grandkid%s" % i for i in range(5)],
+                      [k.kids[0].data for k in kids])
+    self.assertEquals(3, len(storage.queries))
+
+    # and the loaded objects are just as clean as lazy ones:
+    assert not kids[0].parent.private.isDirty
+    assert not hasattr(kids[0].parent.private, 'isStub')
+
+    self.assertRaises(ClerkError, clerk.match, Node, prefetch=["data"])
+
+
+# ** finding N+1 queries
+"""
+To see what the clerk actually asks the storage to do, give the
+storage an instrument such as a StatementLog. Each statement is
+recorded along with what the clerk was doing at the time, and the
+log flags statements that keep running with different values.
+"""
+@testcase
+def test_statement_log(self):
+    storage = RamStorage()
+    clerk = Clerk(storage, TEST_SCHEMA)
+    for x in range(6):
+        clerk.store(Record(value=str(x), next=Record(value="next")))
+
+    log = storage.instrument = StatementLog(nPlusOne=5)
+    clerk = Clerk(storage, TEST_SCHEMA)
+    recs = clerk.match(Record, where.value != "next")
+    [r.next.value for r in recs]
+
+    suspect, = log.suspects()
+    self.assertEquals(6, suspect["count"])
+    self.assertEquals(set(["inject"]), suspect["operations"])
+    assert "ID = %s" in suspect["statement"]
+
+    # prefetching fixes it:
+    log.reset()
+    clerk = Clerk(storage, TEST_SCHEMA)
+    recs = clerk.match(Record, where.value != "next", prefetch=["next"])
+    [r.next.value for r in recs]
+    self.assertEquals([], log.suspects())
+    self.assertEquals(set(["match"]),
+                      set(e.operation for e in log.events))
+
+
 # * avoiding unnecessary writes: the private.isDirty flag
 """
 Every Strongbox has a (semi) private .isDirty flag.
@@ -1114,7 +1479,169 @@ def test_indexed_linkset_injection(self):
     assert top.kids[1].kids == []
     assert top.kids[0].kids[0].data == "a.a"
 
-    
+
+
+# ** bounding the cache
+"""
+By default, the cache keeps every object it ever sees, which is
+a problem for long-running processes. You can give the cache a
+policy instead: LRUPolicy keeps a fixed number of clean objects
+per class, and WeakPolicy lets clean objects go once nothing
+else refers to them. Dirty objects are never dropped (though
+WeakPolicy only learns that an object is dirty when the clerk
+sees it again).
+"""
+@testcase
+def test_lru_cache(self):
+    storage = RamStorage()
+    for x in "abcde":
+        storage.store(RECORD_TABLE, value=x)
+
+    cache = Cache(LRUPolicy(3))
+    clerk = Clerk(storage, TEST_SCHEMA, cache=cache)
+
+    # the table doesn't fit, so it's not marked as fully cached:
+    clerk.match(Record)
+    self.assertEquals([3, 4, 5], sorted(cache.data[Record].keys()))
+    assert Record not in cache.allCached
+    self.assertEquals(2, cache.evictions)
+
+    # using an object makes it the most recently used:
+    clerk.fetch(Record, 3).value = "dirty"
+    clerk.fetch(Record, 1)
+    clerk.fetch(Record, 2)
+    self.assertEquals([1, 2, 3], sorted(cache.data[Record].keys()))
+
+    stats = cache.stats()
+    self.assertEquals(3, stats["size"])
+    self.assertEquals(4, stats["evictions"])
+    assert stats["hits"] and stats["misses"]
+
+
+@testcase
+def test_weak_cache(self):
+    import gc
+    storage = RamStorage()
+    for x in "abc":
+        storage.store(RECORD_TABLE, value=x)
+
+    cache = Cache(WeakPolicy())
+    clerk = Clerk(storage, TEST_SCHEMA, cache=cache)
+    a, b, c = clerk.match(Record)
+    assert Record in cache.allCached
+
+    # the cache finds out about changes when the clerk sees
+    # the object again (changes it never sees go with the object):
+    b.value = "changed"
+    assert clerk.fetch(Record, 2) is b
+    del a, b, c
+    gc.collect()
+
+    # only the dirty one is left, and the table isn't complete anymore:
+    self.assertEquals([2], list(cache.data[Record].keys()))
+    assert Record not in cache.allCached
+
+    # once it's stored, it's clean and can go too:
+    clerk.store(clerk.fetch(Record, 2))
+    gc.collect()
+    self.assertEquals([], list(cache.data[Record].keys()))
+    self.assertEquals("changed", clerk.fetch(Record, 2).value)
+
+    # the cache doesn't watch the objects, so setting values
+    # on them still takes strongbox's fast path:
+    rec = clerk.fetch(Record, 1)
+    assert not rec.private.observers
+    rec.value = "fast"
+    assert rec.private.isDirty
+
+
+
+# * trusted rows
+"""
+Building each object through its constructor runs every value
+through the setters, the .okay validators and the observers. For
+rows the clerk wrote itself, that's wasted work, so a clerk made
+with trusted_rows=True builds new objects with a compiled loader
+that writes the column values straight into .private.
+"""
+@testcase
+def test_trusted_rows(self):
+
+    class Picky(Strongbox):
+        ID = attr(int)
+        name = attr(str, okay=["fred", "wanda"])
+        size = attr(int)
+        parent = link(lambda : Picky)
+        kids = linkset((lambda : Picky), "parent")
+
+    schema = Schema({
+        Picky: "picky",
+        Picky.parent: "parentID",
+    })
+    storage = RamStorage()
+    storage.store("picky", name="fred", size=1, parentID=None)
+    storage.store("picky", name="not okay", size="2", parentID=1)
+
+    clerk = Clerk(storage, schema, trusted_rows=True)
+    fred, other = clerk.match(Picky)
+
+    # the values are loaded without validation, but are still typed:
+    self.assertEquals("not okay", other.name)
+    self.assertEquals(2, other.size)
+    assert not other.private.isDirty
+
+    # links, linksets and the cache all work as usual:
+    assert other.parent is fred
+    assert fred.kids[0] is other
+    assert clerk.fetch(Picky, 2) is other
+
+    # and the objects behave normally afterwards:
+    self.assertRaises(ValueError, setattr, other, "name", "bob")
+    other.name = "wanda"
+    assert other.private.isDirty
+
+    # the loader is only compiled once per column set:
+    self.assertEquals(1, len(clerk._hydrators))
+
+
+# * threads
+"""
+Clerks aren't thread-safe: the cache, the stubs, and the storage
+cursor all change as you load objects. In a threaded server, use
+a ThreadLocalClerk, which builds a separate clerk for each thread
+(usually over a shared storage.ConnectionPool).
+"""
+@testcase
+def test_thread_local_clerk(self):
+    import threading
+    storage = RamStorage()
+    storage.store(RECORD_TABLE, value="shared")
+    clerk = ThreadLocalClerk(lambda: Clerk(storage, TEST_SCHEMA))
+
+    mine = clerk.fetch(Record, 1)
+    assert clerk.fetch(Record, 1) is mine
+    assert clerk.current() is clerk.current()
+
+    seen = []
+    def worker():
+        rec = clerk.fetch(Record, 1)
+        seen.append((clerk.current(), rec))
+        clerk.reset()
+    threads = [threading.Thread(target=worker) for i in range(3)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    # each thread had its own clerk, and so its own copy:
+    self.assertEquals(3, len(set(c for c, r in seen)))
+    assert clerk.current() not in [c for c, r in seen]
+    assert mine not in [r for c, r in seen]
+    self.assertEquals(["shared"] * 3, [r.value for c, r in seen])
+
+    # and reset() starts this thread over:
+    old = clerk.current()
+    clerk.reset()
+    assert clerk.current() is not old
+
 
 # * callbacks
 """
@@ -2,8 +2,9 @@ from storage import *
 from narrative import testcase
 from warnings import warn
 from handy import trim
-from wherewolf import where
+from wherewolf import where, toSQL
 import unittest
+import threading
 
 class StorageTest(unittest.TestCase):
 
@@ -16,11 +17,32 @@ class StorageTest(unittest.TestCase):
         self.assertEquals( toSQL(o.clause), toSQL(where.ID==5))
 
 
+    def test_dictify(self):
+        class FakeCursor(object):
+            description = (("ID", 3), ("kind", 254))
+            def fetchall(self):
+                return [(1, set(["enum"])), (2, "plain")]
+        class FakeDB(object):
+            def cursor(self):
+                return FakeCursor()
+        s = MySQLStorage(FakeDB())
+        s.setTypes = None # unknown driver: check everything
+        self.assertEquals([{"ID":1, "kind":"enum"}, {"ID":2, "kind":"plain"}],
+                          s._dictify(s.cur))
+        s.setTypes = frozenset([3]) # only the ID column could be a set
+        self.assertEquals(set(["enum"]), s._dictify(s.cur)[0]["kind"])
+
+
 class RamStorageTest(unittest.TestCase):
 
     def setUp(self):
         self.s = RamStorage()
 
+    def test_bytes(self):
+        # binary values go in untouched:
+        ID = self.s.store("test_person", name=b"\x00\xffbin")["ID"]
+        self.assertEquals(b"\x00\xffbin", self.s.fetch("test_person", ID)["name"])
+
     def test_quotes(self):
         self.s.store("test_person", name="sally o'malley")
         self.assertEquals(1, len(self.s.match("test_person",
@@ -118,6 +140,90 @@ class RamStorageTest(unittest.TestCase):
         assert self.wholedb() == [{"ID":1, "name":"frood"},
                                   {"ID":2, "name":"wanda"}]        
 
+    def test_insertMany(self):
+        self.populate()
+        ids = self.s.insertMany("test_person", [{"ID":0, "name":"rick"},
+                                                {"name":"bob"}])
+        self.assertEquals([3, 4], ids)
+        self.assertEquals(["fred", "wanda", "rick", "bob"],
+                          [p["name"] for p in self.wholedb()])
+
+    def test_updateMany(self):
+        self.populate()
+        self.s.updateMany("test_person", [{"ID":1, "name":"frood"},
+                                          {"ID":2, "name":"wendy"}])
+        self.assertEquals(self.wholedb(),
+                          [{"ID":1, "name":"frood"},
+                           {"ID":2, "name":"wendy"}])
+
+    def test_rollback(self):
+        self.populate()
+        self.s.begin()
+        self.s.updateMany("test_person", [{"ID":1, "name":"frood"}])
+        self.s.store("test_person", name="rick")
+        self.s.rollback()
+        self.assertEquals(self.wholedb(),
+                          [{"ID":1, "name":"fred"},
+                           {"ID":2, "name":"wanda"}])
+        self.s.begin()
+        self.s.store("test_person", name="rick")
+        self.s.commit()
+        self.assertEquals(3, len(self.wholedb()))
+
+    def test_predicates(self):
+        self.test_store_insertExtra()
+        self.s.store("test_person", name=None)
+        names = lambda rows: sorted(p["name"] for p in rows)
+        self.assertEquals(["bob", "fred", "jack"],
+                          names(self.s.match("test_person",
+                                             where.ID.isin([1, 4, 5, 99]))))
+        self.assertEquals(["rick", "wanda"],
+                          names(self.s.match("test_person",
+                                             where.ID.between(2, 3))))
+        self.assertEquals([6], [p["ID"] for p in
+                                self.s.match("test_person",
+                                             where.name.isnull())])
+        self.assertEquals([], self.s.match("test_person", where.ID.isin([])))
+
+    def test_simplify(self):
+        self.test_store_insertExtra()
+        self.assertEquals([], self.s.match("test_person",
+                                           (where.ID == 1) & (where.ID == 2)))
+        self.s.delete("test_person", (where.ID > 3) & (where.ID < 2))
+        self.assertEquals(5, len(self.wholedb()))
+        self.assertEquals(["fred", "wanda"],
+                          [p["name"] for p in self.s.match(
+                              "test_person", (where.ID == 1) | (where.ID == 2),
+                              orderBy="ID")])
+        self.assertEquals(5, len(self.s.match("test_person",
+                                              where.ID.isin([]) | (where.ID > 0))))
+
+    def test_match_page(self):
+        self.test_store_insertExtra()
+        self.assertEquals([{"ID":1, "name":"fred"}, {"ID":5, "name":"jack"}],
+                          self.s.match("test_person", orderBy="name",
+                                       limit=2, offset=1))
+        self.assertEquals(["rick", "wanda"],
+                          [p["name"] for p in
+                           self.s.match("test_person", orderBy="name", offset=3)])
+        self.assertEquals([{"name":"wanda"}],
+                          self.s.match("test_person", where.ID == 2,
+                                       columns=["name"]))
+
+    def test_iterMatch(self):
+        self.test_store_insertExtra()
+        rows = self.s.iterMatch("test_person", where.ID > 1,
+                                orderBy="name", batchSize=2)
+        assert not isinstance(rows, list)
+        names = []
+        for row in rows:
+            # other queries still work while we stream (even on MySQL,
+            # which pages through the result instead; see
+            # ConnectionPoolTest.test_iterMatch_apart):
+            self.assertEquals(row, self.s.fetch("test_person", row["ID"]))
+            names.append(row["name"])
+        self.assertEquals(["bob", "jack", "rick", "wanda"], names)
+
     def test_match(self):
         assert self.wholedb() == []
         self.populate()
@@ -150,6 +256,181 @@ class RamStorageTest(unittest.TestCase):
 
 
 
+class RamStoreTest(unittest.TestCase):
+
+    def test_compiled_predicates(self):
+        from ramstore import compilePredicate
+        s = RamStorage()
+        s.store("test_person", name="fred")
+        s.store("test_person", name="frank")
+        # expressions of the same shape share one compiled predicate,
+        # with the constants passed in alongside it:
+        code, env = compilePredicate(where.name % 'fr%')
+        other, otherEnv = compilePredicate(where.name % 'wa%')
+        assert code is other
+        self.assertEquals('fr%', env['_p0'])
+        self.assertEquals('wa%', otherEnv['_p0'])
+        assert compilePredicate(where.ID.isin([1, 2]))[0] \
+            is compilePredicate(where.ID.isin([3, 4]))[0]
+        rows = s.match("test_person", where.name % 'fr%')
+        self.assertEquals(2, len(rows))
+        # and the stored rows aren't used as the eval() globals:
+        assert "__builtins__" not in rows[0]
+
+    def test_rollback_undo(self):
+        s = RamStorage()
+        for name in ["fred", "wanda", "rick"]:
+            s.store("test_person", name=name)
+        s.store("test_other", name="untouched")
+        s.addIndex("test_person", "name")
+        s.addIndex("test_other", "name")
+        other = s._indexes["test_other"]["name"]
+        fred = s.fetch("test_person", 1)
+
+        s.begin()
+        s.store("test_person", ID=1, name="frood")
+        s.delete("test_person", 2)
+        s.store("test_person", name="bob")
+        s.store("test_new", name="new")
+        s.rollback()
+
+        # rows come back in place and in order, without copying
+        # the whole store, and only the touched tables get reindexed:
+        self.assertEquals(["fred", "wanda", "rick"],
+                          [p["name"] for p in s.match("test_person")])
+        assert s.fetch("test_person", 1) is fred
+        self.assertEquals([2], [p["ID"] for p in
+                                s.match("test_person", where.name == "wanda")])
+        assert s._indexes["test_other"]["name"] is other
+        self.assertEquals([], s.match("test_new"))
+        self.assertEquals(4, s.store("test_person", name="bob")["ID"])
+        self.assertEquals(1, s.store("test_new", name="new")["ID"])
+
+    def test_simplify_skips(self):
+        s = RamStorage()
+        s.store("test_person", name="fred")
+        log = s.instrument = StatementLog()
+        # python can tell a clause can't match anything, so it
+        # doesn't bother looking:
+        self.assertEquals([], s.match("test_person",
+                                      (where.ID == 1) & (where.ID == 2)))
+        s.delete("test_person", (where.ID > 3) & (where.ID < 2))
+        self.assertEquals([], log.events)
+
+    def test_instrument_writes(self):
+        s = RamStorage()
+        log = s.instrument = StatementLog()
+        s.store("test_person", name="fred")
+        s.store("test_person", ID=1, name="frood")
+        s.delete("test_person", 1)
+        # one event per statement, with nothing extra for the update:
+        self.assertEquals(["INSERT INTO test_person",
+                           "UPDATE test_person WHERE (ID = %s)",
+                           "DELETE FROM test_person WHERE (ID = %s)"],
+                          [e.statement for e in log.events])
+        self.assertEquals([1, 1, 1], [e.rows for e in log.events])
+        self.assertRaises(LookupError, s.store, "test_person", ID=1, name="x")
+
+    def test_indexes(self):
+        s = RamStorage()
+        for name, age in [("fred", 30), ("wanda", 25),
+                          ("rick", 40), ("bob", 25)]:
+            s.store("test_person", name=name, age=age)
+        s.addIndex("test_person", "name")
+        s.addIndex("test_person", "age", ordered=True)
+
+        # the indexes narrow down the rows to check:
+        self.assertEquals(1, len(s._candidates("test_person",
+                                               where.name == "rick")))
+        self.assertEquals(2, len(s._candidates("test_person",
+                                               (where.age <= 25)
+                                               & (where.name != "x"))))
+        assert s._candidates("test_person", where.name % "f%") is None
+
+        # but results still come back in table order:
+        self.assertEquals(["wanda", "rick", "bob"],
+                          [p["name"] for p in
+                           s.match("test_person", where.age != 30)])
+        self.assertEquals(["wanda", "bob"],
+                          [p["name"] for p in
+                           s.match("test_person", where.age < 30)])
+
+        # and the indexes keep up with changes:
+        row = s.fetch("test_person", 2)
+        row["age"] = 50
+        s.store("test_person", **row)
+        s.delete("test_person", 3)
+        self.assertEquals(["bob"], [p["name"] for p in
+                                    s.match("test_person", where.age < 30)])
+        self.assertEquals(["wanda"], [p["name"] for p in
+                                      s.match("test_person", where.age > 30)])
+        self.assertEquals([], s.match("test_person", where.name == "rick"))
+        self.assertRaises(LookupError, s.fetch, "test_person", 3)
+
+    def test_indexed_predicates(self):
+        s = RamStorage()
+        for name, age in [("fred", 30), ("wanda", 25),
+                          ("rick", None), ("bob", 25)]:
+            s.store("test_person", name=name, age=age)
+        s.addIndex("test_person", "name")
+        s.addIndex("test_person", "age", ordered=True)
+        self.assertEquals([1, 3], [r["ID"] for r in s._candidates(
+            "test_person", where.ID.isin([3, 1, 3, 7]))])
+        self.assertEquals(2, len(s._candidates(
+            "test_person", where.name.isin(["fred", "bob", "nobody"]))))
+        self.assertEquals(3, len(s._candidates(
+            "test_person", where.age.between(20, 30))))
+        # the sorted index leaves out the NULLs, but the hash index has them:
+        assert s._candidates("test_person", where.age.isnull()) is None
+        self.assertEquals(["rick"], [r["name"] for r in
+                                     s.match("test_person", where.age.isnull())])
+        self.assertEquals([], s._candidates("test_person", where.name.isnull()))
+
+    def test_mixed_types(self):
+        s = RamStorage()
+        for name, age in [("fred", 30), ("wanda", "old"), ("rick", None),
+                          ("bob", 25.5), ("jack", "young")]:
+            s.store("test_person", name=name, age=age)
+        s.addIndex("test_person", "age", ordered=True)
+        names = lambda rows: sorted(p["name"] for p in rows)
+        # a range only covers the values of the same kind:
+        self.assertEquals(["bob", "fred"],
+                          names(s._candidates("test_person", where.age > 0)))
+        self.assertEquals(["bob"],
+                          names(s._candidates("test_person", where.age < 30)))
+        self.assertEquals(["wanda"],
+                          names(s._candidates("test_person", where.age <= "old")))
+        self.assertEquals(["jack"],
+                          names(s._candidates("test_person", where.age == "young")))
+        s.store("test_person", ID=1, age="older")
+        self.assertEquals(["fred", "jack"],
+                          names(s._candidates("test_person", where.age > "old")))
+        # and sorting agrees: NULL, then numbers, then the rest by type:
+        self.assertEquals(["rick", "bob", "wanda", "fred", "jack"],
+                          [p["name"] for p in
+                           s.match("test_person", orderBy="age")])
+
+    def test_paging(self):
+        s = RamStorage()
+        for name, age in [("fred", 30), ("wanda", 25), ("rick", None),
+                          ("bob", 25), ("jack", 40)]:
+            s.store("test_person", name=name, age=age)
+        names = lambda rows: [p["name"] for p in rows]
+        # NULL sorts first, and ties keep table order:
+        self.assertEquals(["rick", "wanda", "bob", "fred", "jack"],
+                          names(s.match("test_person", orderBy="age")))
+        self.assertEquals(["jack", "fred", "bob", "wanda", "rick"],
+                          names(s.match("test_person", orderBy="age desc, name")))
+        self.assertEquals(["wanda", "fred"],
+                          names(s.match("test_person", orderBy="age, name",
+                                        limit=2, offset=2)))
+        self.assertEquals(["jack", "rick", "wanda"],
+                          names(s.match("test_person", where.ID > 1,
+                                        orderBy="name", offset=1)))
+        self.assertEquals(["fred", "wanda"],
+                          names(s.match("test_person", limit=2)))
+
+
 class MySQLStorageTest(RamStorageTest):
     """
     To run this test, you need to create a test database
@@ -221,8 +502,191 @@ class PySQLiteStorageTest(RamStorageTest):
         self.s.store("test_person", **row)
         assert self.wholedb() == [{"ID":1, "name":"j'mo\"cha's'ha''ha"},
                                   {"ID":2, "name":"wanda"}]        
+
+    def test_sql_comparisons(self):
+        # the database compares by its own rules: python would call
+        # this a contradiction, but here the strings become numbers:
+        self.test_store_insertExtra()
+        log = self.s.instrument = StatementLog()
+        self.assertEquals([3, 4, 5], [p["ID"] for p in self.s.match(
+            "test_person", (where.ID > "2") & (where.ID < "10"), orderBy="ID")])
+        # so even a clause that looks hopeless goes to the db:
+        self.assertEquals([], self.s.match("test_person",
+                                           (where.ID == 1) & (where.ID == 2)))
+        self.assertEquals(2, len(log.events))
+
+    def test_params(self):
+        # what the driver binds goes in as it is, and the rest as strings:
+        from pytypes import Date
+        from decimal import Decimal
+        import datetime
+        day = Date("2001-02-03")
+        self.assertEquals(str(day), self.s._toParam(day))
+        for val in [None, True, 5, 1.5, "abc", b"\x00\xff", Decimal("1.10"),
+                    datetime.date(2001, 2, 3), datetime.datetime(2001, 2, 3)]:
+            assert self.s._toParam(val) is val
+        class Money(object):
+            def __str__(self):
+                return "$5"
+        self.assertEquals("$5", self.s._toParam(Money()))
+
+    def test_store_fixedpoint(self):
+        from FixedPoint import FixedPoint
+        ID = self.s.store("test_person", name=FixedPoint("1.50"))["ID"]
+        self.assertEquals("1.50", self.s.fetch("test_person", ID)["name"])
+
+    def test_instrument(self):
+        log = self.s.instrument = StatementLog()
+        self.populate()
+        self.s.match("test_person", where.name == "fred")
+        event = log.events[-1]
+        self.assertEquals("SELECT * FROM test_person WHERE (name = ?)",
+                          event.statement)
+        self.assertEquals(["fred"], event.params)
+        self.assertEquals(1, event.rows)
+        assert event.seconds >= 0
+
+    def test_statement_cache(self):
+        # the values are bound as parameters, so queries with
+        # the same shape share one statement:
+        self.populate()
+        self.s.match("test_person", where.name == "fred")
+        count = len(self.s._statements)
+        self.assertEquals(1, len(self.s.match("test_person",
+                                              where.name == "o'wanda'")
+                                 + self.s.match("test_person",
+                                                where.name == "wanda")))
+        self.assertEquals(count, len(self.s._statements))
         
 
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile, os
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        dbc = sqlite.connect(self.path)
+        dbc.execute("CREATE TABLE test_person (ID int primary key, "
+                    "name varchar(32))")
+        dbc.commit()
+        dbc.close()
+        self.pool = ConnectionPool(
+            lambda: sqlite.connect(self.path, check_same_thread=False),
+            maxSize=1, timeout=0.1)
+
+    def tearDown(self):
+        import os
+        self.pool.close()
+        os.remove(self.path)
+
+    def test_checkout(self):
+        one = PySQLiteStorage(pool=self.pool)
+        two = PySQLiteStorage(pool=self.pool)
+        one.store("test_person", name="fred")
+        # one still has the only connection:
+        self.assertRaises(PoolTimeout, two.match, "test_person")
+        dbc = one.dbc
+        one.release()
+        self.assertEquals(["fred"], [p["name"] for p in two.match("test_person")])
+        assert two.dbc is dbc
+        two.release()
+        self.assertEquals(1, self.pool.size)
+
+    def test_release_in_transaction(self):
+        s = PySQLiteStorage(pool=self.pool)
+        s.begin()
+        s.store("test_person", name="fred")
+        dbc = s.dbc
+        s.release()
+        # the connection goes back once, and without the transaction:
+        self.assertEquals(1, self.pool.size)
+        self.assertEquals([dbc], [c for c, since in self.pool.idle])
+        assert not s.inTransaction
+        self.assertEquals([], s.match("test_person"))
+        s.release()
+
+    def test_idle_timeout(self):
+        s = PySQLiteStorage(pool=self.pool)
+        dbc = s.dbc
+        s.release()
+        self.pool.idleTimeout = 0
+        assert s.dbc is not dbc
+        self.assertEquals(1, self.pool.size)
+
+    def test_health_check_unlocked(self):
+        # other threads can use the pool while a health check runs:
+        pool = self.pool
+        free = []
+        def tryLock():
+            got = pool._lock.acquire(False)
+            if got:
+                pool._lock.release()
+            free.append(got)
+        def isHealthy(dbc):
+            t = threading.Thread(target=tryLock)
+            t.start()
+            t.join()
+            return True
+        s = PySQLiteStorage(pool=pool)
+        dbc = s.dbc
+        s.release()
+        pool.isHealthy = isHealthy
+        assert s.dbc is dbc
+        self.assertEquals([True], free)
+        s.release()
+
+    def test_reconnect(self):
+        s = PySQLiteStorage(pool=self.pool)
+        s.store("test_person", name="fred")
+        s.dbc.close() # the connection dies...
+        self.assertEquals(["fred"], [p["name"] for p in s.match("test_person")])
+        # but real errors still come through:
+        self.assertRaises(Exception, s.match, "no_such_table")
+
+    def test_iterMatch_apart(self):
+        # MySQL can't run anything else on a connection while a
+        # result streams in, so the stream gets its own connection:
+        class OneResultStorage(PySQLiteStorage):
+            streamsShareConnection = False
+        self.pool.maxSize = 2
+        s = OneResultStorage(pool=self.pool)
+        for name in ["fred", "wanda", "rick"]:
+            s.store("test_person", name=name)
+        names = []
+        for row in s.iterMatch("test_person", orderBy="name", batchSize=2):
+            assert s.dbc is not None
+            self.assertEquals(row, s.fetch("test_person", row["ID"]))
+            names.append(row["name"])
+        self.assertEquals(["fred", "rick", "wanda"], names)
+        self.assertEquals(2, self.pool.size)
+        self.assertEquals(1, len(self.pool.idle)) # the stream's, back again
+
+        # in a transaction (or with no pool) it asks for a page at a time:
+        log = s.instrument = StatementLog()
+        s.begin()
+        self.assertEquals(names, [row["name"] for row in
+                                  s.iterMatch("test_person", orderBy="name",
+                                              batchSize=2)])
+        s.commit()
+        self.assertEquals(2, len([e for e in log.events
+                                  if e.statement.startswith("SELECT")]))
+        self.assertEquals(2, self.pool.size)
+
+        # with no orderBy, each page starts after the last ID it saw,
+        # so deleting rows as we go doesn't make it skip any:
+        log.reset()
+        s.begin()
+        names = []
+        for row in s.iterMatch("test_person", batchSize=2):
+            s.delete("test_person", row["ID"])
+            names.append(row["name"])
+        s.commit()
+        self.assertEquals(["fred", "wanda", "rick"], names)
+        selects = [e.statement for e in log.events
+                   if e.statement.startswith("SELECT")]
+        assert "(ID > ?)" in selects[-1]
+
+
 if __name__ == '__main__':
 
     try:
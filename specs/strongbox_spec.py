@@ -381,6 +381,13 @@ def test_okay_list(test):
 
     # you can get the .okay value at runtime from Paint.color
     assert Paint.color.okay == ["red", "green", "blue"]
+
+    # (the check uses a set when it can, but anything works)
+    class Path(BlackBox):
+        point = attr(list, okay=[[0, 0], [1, 1]])
+    path = Path()
+    path.point = [1, 1]
+    test.assertRaises(ValueError, setattr, path, "point", [2, 2])
     
 # *** function validators
 """
@@ -625,6 +632,28 @@ def test_getSlots(test):
     test.assertEquals([("c", Foo.c)], list(foo.getSlotsOfType(link)))
 
 
+"""
+<p>The slot tables are built once, when the class is created,
+so you can ask the class itself without making an instance.
+They include everything inherited from further up the tree.</p>
+"""
+@narr.testcase
+def test_getSlots_classmethod(test):
+    class Grandpa(StrongBox):
+        a = attr(str)
+    class Dad(Grandpa):
+        b = attr(int)
+    class Son(Dad):
+        c = link(Dad)
+        kids = linkset(lambda: Son, None)
+
+    test.assertEquals(["a", "b", "c", "kids"],
+                      [slot for slot, _ in Son.getSlots()])
+    assert Son.getSlots() is Son().getSlots()
+    test.assertEquals([("kids", Son.kids)], list(Son.getSlotsOfType(linkset)))
+    test.assertEquals(["a", "b"], Dad.listWritableSlots())
+
+
 # ** listWritableSlots
 """
 <p>Sometimes, you want to cache calculated fields (get_xxx without
@@ -742,6 +771,54 @@ def test_Injectable(self):
     assert injector in subject.private.injectors
     subject.removeInjector(injector)
     assert injector not in subject.private.injectors
+
+# * Private Records
+"""
+<p>Each <code>StrongBox</code> class gets its own <code>.private</code>
+record, with a slot for each attribute, so boxes don't need a dict
+for their data. The observer and injector lists aren't made until
+something subscribes.</p>
+"""
+@narr.testcase
+def test_private_record(self):
+    class Point(StrongBox):
+        x = attr(int)
+        y = attr(int)
+    p = Point(x=1, y=2)
+    assert isinstance(p.private, Private)
+    assert "x" in Point._Private.__slots__
+    self.assertEquals(2, p.private.y)
+    assert p.private.observers is None
+    assert p.private.injectors is None
+    assert not hasattr(p.private, "isStub")
+    p.addObserver(self)
+    self.assertEquals([self], p.private.observers)
+    # you can still keep other things in there:
+    p.private.extra = "ok"
+    self.assertEquals("ok", p.private.extra)
+    # and the record still copies (and pickles) like before:
+    import copy
+    self.assertEquals(2, copy.copy(p.private).y)
+    self.assertEquals("ok", copy.copy(p.private).extra)
+
+class Pickled(StrongBox):
+    x = attr(int)
+    kids = linkset(lambda: Pickled, None)
+
+@narr.testcase
+def test_pickle_record(self):
+    import pickle, sys
+    # pickle finds classes through their module. (runtests execs
+    # the specs in its own namespace, so point it there.)
+    sys.modules.setdefault(Pickled.__module__, sys.modules["__main__"])
+    box = Pickled(x=5)
+    box.kids << Pickled(x=6)
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        again = pickle.loads(pickle.dumps(box, protocol))
+        self.assertEquals(5, again.x)
+        self.assertEquals([6], [k.x for k in again.kids])
+        assert again.private.isDirty
+        assert not hasattr(again.private, "isStub")
    
 
     # First the setter. Setters are easy. This is very useful for
@@ -824,6 +901,27 @@ def test_isDirty(self):
     assert d.private.isDirty
 
 
+# *** hooks
+"""
+<p>When a box has no observers or injectors, reading and writing
+attributes skips the hooks entirely. Classes that override
+<code>onGet</code> or <code>onSet</code> still get called, though:</p>
+"""
+@narr.testcase
+def test_custom_hooks(self):
+    class Noisy(StrongBox):
+        x = attr(int)
+        def onGet(self, slot):
+            self.private.heard = "get " + slot
+        def onSet(self, slot, value):
+            self.private.heard = "set %s=%s" % (slot, value)
+    n = Noisy()
+    n.x = 5
+    self.assertEquals("set x=5", n.private.heard)
+    self.assertEquals(5, n.x)
+    self.assertEquals("get x", n.private.heard)
+
+
 # * unit tests
 """
 <p>This is the trick that makes the unit tests run:</p>
@@ -13,6 +13,106 @@ class SQLTest(unittest.TestCase):
     def test_escape(self):
         self.assertEquals( sql(where.x == "I'm") , "(x = 'I''m')")
 
+    def test_params(self):
+        self.assertEquals(toParamSQL(where.x > 10), ("(x > %s)", [10]))
+        self.assertEquals(
+            toParamSQL((where.name == "I'm") & (where.y % 'f%'), '?'),
+            ("((name = ?) AND (y LIKE ?))", ["I'm", 'f%']))
+
+    def test_paramPython(self):
+        self.assertEquals(toParamPython(where.x > 10), ("(x > _p0)", {'_p0': 10}))
+        code, params = toParamPython((where.ID.isin([1, 2]) & (where.y % 'f%')))
+        self.assertEquals("((ID in _p0) and _like(y, _p2))", code)
+        self.assertEquals({'_p0': frozenset([1, 2]), '_p2': 'f%'}, params)
+        params.update(_like=like)
+        assert eval(code, params, {"ID": 2, "y": "fred"})
+        assert not eval(code, params, {"ID": 3, "y": "fred"})
+
+    def test_predicates(self):
+        self.assertEquals(sql(where.ID.isin([1, 2, 3])), "(ID IN (1, 2, 3))")
+        self.assertEquals(sql(where.ID.isin([])), "(1 = 0)")
+        self.assertEquals(sql(where.x.between(1, 5)), "(x BETWEEN 1 AND 5)")
+        self.assertEquals(sql(where.x.isnull()), "(x IS NULL)")
+        self.assertEquals(toParamSQL(where.ID.isin([1, 2]) & where.y.isnull(), '?'),
+                          ("((ID IN (?, ?)) AND (y IS NULL))", [1, 2]))
+        self.assertEquals(toPython(where.ID.isin([1, 2])), "(ID in {1, 2})")
+        self.assertEquals(toPython(where.x.between(1, 5)), "(1 <= x <= 5)")
+        self.assertEquals(toPython(where.x.isnull()), "(x is None)")
+
+    def test_long_chains(self):
+        # neither building nor compiling should recurse per term:
+        ex = where.x == 0
+        for i in range(1, 5000):
+            ex = ex | (where.x == i)
+        self.assertEquals(5000, len(ex.terms))
+        assert toSQL(ex).startswith("((x = 0) OR (x = 1) OR ")
+        self.assertEquals(list(range(5000)), toParamSQL(ex)[1])
+        assert eval(toPython(ex), {}, {"x": 4999})
+        deep = where.x
+        for i in range(5000):
+            deep = deep + 1
+        assert toSQL(deep).endswith(" + 1) + 1)")
+
+    def test_long_and_chains(self):
+        # (and the same for &, which simplify checks for contradictions)
+        ex = where.x != 0
+        for i in range(1, 5000):
+            ex = ex & (where.x != i)
+        self.assertEquals(5000, len(ex.terms))
+        assert toSQL(ex).startswith("((x != 0) AND (x != 1) AND ")
+        self.assertEquals(list(range(5000)), toParamSQL(ex)[1])
+        assert eval(toPython(ex), {}, {"x": 5000})
+        assert not eval(toPython(ex), {}, {"x": 4999})
+
+    def test_simplify(self):
+        want = lambda ex, goal: self.assertEquals(goal, sql(simplify(ex)))
+        want((where.x == 1) & (where.x == 1), "(x = 1)")
+        want(Const(True) & (where.p == 1), "(p = 1)")
+        want((where.x + (Const(1) + 2)) < 5, "((x + 3) < 5)")
+        want((where.x == 1) | (where.y == 2) | (where.x == 3) | where.x.isin([1, 4]),
+             "((x IN (1, 3, 4)) OR (y = 2))")
+        want(where.x.isin([]) | (where.y == 1), "(y = 1)")
+        for never in [(where.x == 1) & (where.x == 2),
+                      (where.x > 5) & (where.x <= 5),
+                      where.x.isin([1, 2]) & (where.x == 3),
+                      where.x.isnull() & (where.x == 1),
+                      where.x.between(1, 3) & (where.x == 5)]:
+            assert isFalse(simplify(never)), never
+        # the usual kind of query is left alone:
+        ex = (where.x == 1) & (where.y > 2)
+        assert simplify(ex) is ex
+        # toPython simplifies first:
+        self.assertEquals("(x in {1, 2})",
+                          toPython((where.x == 1) | (where.x == 2)))
+        self.assertEquals("False", toPython((where.x > "5") & (where.x < "10")))
+
+    def test_simplifyForSQL(self):
+        # the database compares by its own rules, so the sql only
+        # gets the changes that hold everywhere:
+        want = lambda ex, goal: self.assertEquals(goal, sql(ex))
+        want((where.x == 1) & (where.x == 1), "(x = 1)")
+        want((where.x + (Const(1) + 2)) < 5, "((x + 3) < 5)")
+        want(Const(True) & (where.p == 1), "(p = 1)")
+        want((Const(1) == 2) | (where.p == 1), "(p = 1)")
+        want(where.x.isin([]) | (where.y == 1), "(y = 1)")
+        # an int column in sqlite turns these into numbers:
+        want((where.x > "5") & (where.x < "10"), "((x > '5') AND (x < '10'))")
+        # collations may say 'a' = 'A':
+        want((Const("a") == "A") | (where.p == 1), "(('a' = 'A') OR (p = 1))")
+        want((where.x == 1) & (where.x == 2), "((x = 1) AND (x = 2))")
+        self.assertEquals(("((x = ?) OR (x = ?))", [1, 2]),
+                          toParamSQL((where.x == 1) | (where.x == 2), '?'))
+        ex = (where.x == 1) & (where.y > 2)
+        assert simplifyForSQL(ex) is ex
+
+    def test_shape_cache(self):
+        one, params = toParamSQL(where.x == 1)
+        two, params = toParamSQL(where.x == 2)
+        assert one is two # only built once
+        self.assertEquals([2], params)
+        assert toSQL(where.x == 1) is toSQL(where.x == 1)
+        self.assertEquals("(x = 2)", toSQL(where.x == 2))
+
     def test_pyLike(self):
         self.assertEquals(toPython(where.name % 'f%'), "name.startswith('f')")
         self.assertEquals(toPython(where.name % '%d'), "name.endswith('d')")